@@ -1,9 +1,82 @@
-from flask import Flask, request, render_template
+from flask import Flask, request, render_template, jsonify
+import atexit
+import os
+import time
 import asyncio
-from scraper import scrape_listings
+import threading
+from scraper import scrape_listings, warm_up, get_proxy_url, COOKIES, LOCATION_ID
+from client import get_client
+from background import BackgroundLoop
+from cache import ResultCache, shared_cache
+from storage import ListingStore
 
 app = Flask(__name__)
 
+# Every request in this worker runs on one event loop and shares its client
+engine = BackgroundLoop()
+
+# Hot queries are answered from memory or the cache shared by all workers,
+# and identical concurrent ones share a scrape
+result_cache = ResultCache(shared=shared_cache)
+
+# Every scraped listing is also kept in the listings database for /api/listings
+listing_store = ListingStore()
+
+# Give up on a scrape that takes longer than this (seconds)
+SCRAPE_TIMEOUT = 120
+
+# Requests wait at most this long for a running warm-up before scraping anyway (seconds)
+WARM_UP_TIMEOUT = 30
+
+_warm_up = {"pid": None, "future": None}
+_warm_up_lock = threading.Lock()
+
+async def run_warm_up():
+    client = get_client(COOKIES, get_proxy_url(for_aiohttp=True))
+    return await warm_up(client=client)
+
+def start_warm_up():
+    """Start preloading on this worker's loop, once per process. Returns its future."""
+    with _warm_up_lock:
+        if _warm_up["pid"] != os.getpid():
+            _warm_up["pid"] = os.getpid()
+            _warm_up["future"] = engine.submit(run_warm_up())
+        return _warm_up["future"]
+
+def is_ready():
+    """True once this worker's warm-up finished with everything loaded."""
+    future = start_warm_up()
+    return future.done() and not future.cancelled() and future.exception() is None and future.result()
+
+def wait_for_warm_up():
+    """Let a request that arrives during warm-up reuse it instead of discovering in parallel."""
+    try:
+        start_warm_up().result(WARM_UP_TIMEOUT)
+    except Exception:
+        pass
+
+async def run_scrape(query, max_items):
+    """Scrape through the worker's pooled client, going through the result cache."""
+    client = get_client(COOKIES, get_proxy_url(for_aiohttp=True))
+
+    async def scrape(query, max_items):
+        listings = await scrape_listings(query, max_items, client=client)
+        # Off the loop, so a write lock held by another worker never stalls other scrapes
+        await asyncio.to_thread(listing_store.upsert_many, listings, query=query)
+        return listings
+
+    return await result_cache.get_or_scrape(query, LOCATION_ID, max_items, scrape)
+
+async def close_client():
+    await get_client().close()
+
+@atexit.register
+def shutdown():
+    """Close the pooled connections and stop the loop thread on exit."""
+    if engine.running:
+        engine.run(close_client(), timeout=5)
+        engine.stop()
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
@@ -11,10 +84,51 @@ def index():
         max_items = int(request.form.get('max_items', 50))
         if max_items > 100:
             max_items = 100  # Limit to prevent abuse
-        # Run the scraper
-        listings = asyncio.run(scrape_listings(query, max_items))
+        wait_for_warm_up()
+        # Run the scraper on the worker's shared event loop
+        listings = engine.run(run_scrape(query, max_items), timeout=SCRAPE_TIMEOUT)
         return render_template('results.html', listings=listings, query=query)
     return render_template('index.html')
 
+def float_arg(name):
+    value = request.args.get(name)
+    try:
+        return float(value) if value not in (None, '') else None
+    except ValueError:
+        return None
+
+@app.route('/api/listings')
+def api_listings():
+    """
+    Query stored listings, e.g. /api/listings?city=Rajshahi&max_price=500.
+    Filters: city, category, query, min_price, max_price, hours (seen in the
+    last N hours), include_sold, order_by, limit, offset.
+    """
+    hours = float_arg('hours')
+    try:
+        listings = listing_store.query_listings(
+            city=request.args.get('city'),
+            category_id=request.args.get('category'),
+            query=request.args.get('query'),
+            min_price=float_arg('min_price'),
+            max_price=float_arg('max_price'),
+            seen_since=time.time() - hours * 3600 if hours else None,
+            include_sold=request.args.get('include_sold', '1') != '0',
+            order_by=request.args.get('order_by', 'last_seen'),
+            limit=int(request.args.get('limit', 100)),
+            offset=int(request.args.get('offset', 0)),
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"count": len(listings), "listings": listings})
+
+@app.route('/ready')
+def ready():
+    """Readiness probe: 200 once doc_ids and browse params are preloaded."""
+    if is_ready():
+        return 'ready', 200
+    return 'warming up', 503
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    start_warm_up()
+    app.run(debug=True, threaded=True)
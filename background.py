@@ -0,0 +1,71 @@
+import asyncio
+import os
+import threading
+import concurrent.futures
+
+
+class BackgroundLoop:
+    """
+    One long-lived asyncio event loop running in a daemon thread.
+
+    Synchronous code (Flask views) submits coroutines to it, so every request
+    in the process shares the same loop, MarketplaceClient connection pool and
+    caches, and many scrapes can be in flight at once. The thread is started
+    lazily and restarted after a fork, so it is safe with gunicorn --preload.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        """The running loop, started on first use in this process."""
+        with self._lock:
+            if not self.running:
+                self._start()
+            return self._loop
+
+    @property
+    def running(self):
+        """True if the loop thread has been started in this process."""
+        return self._loop is not None and self._pid == os.getpid()
+
+    def _start(self):
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.call_soon(ready.set)
+            loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="marketplace-loop", daemon=True)
+        self._thread.start()
+        ready.wait()
+        self._loop = loop
+        self._pid = os.getpid()
+
+    def submit(self, coro):
+        """Schedule coro on the loop and return a concurrent.futures.Future for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """Run coro on the loop and block the calling thread until it finishes."""
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def stop(self):
+        """Stop the loop thread if it was started in this process."""
+        with self._lock:
+            if not self.running:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+            self._loop = None
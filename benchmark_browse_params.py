@@ -0,0 +1,122 @@
+import re
+import sys
+import json
+import time
+from helper import extract_browse_params
+
+# The regex cascade extract_browse_params used before the single-pass scanner, kept for comparison
+LEGACY_BROWSE_PARAM_PATTERNS = [
+    re.compile(r'browse_request_params["\s]*:[\s]*({[^}]*})', re.IGNORECASE | re.DOTALL),
+    re.compile(r'browse_request_params\s*:\s*({[^}]*})', re.IGNORECASE | re.DOTALL),
+    re.compile(r'"browse_request_params"\s*:\s*({[^}]*})', re.IGNORECASE | re.DOTALL),
+    re.compile(r'browse_request_params"\s*:\s*\{([^}]*)\}', re.IGNORECASE | re.DOTALL),
+]
+
+LEGACY_LAT_PATTERNS = [
+    re.compile(r'filter_location_latitude["\s]*:[\s]*([0-9.-]+)', re.IGNORECASE),
+    re.compile(r'latitude["\s]*:[\s]*([0-9.-]+)', re.IGNORECASE),
+    re.compile(r'"lat"\s*:\s*([0-9.-]+)', re.IGNORECASE),
+]
+
+LEGACY_LON_PATTERNS = [
+    re.compile(r'filter_location_longitude["\s]*:[\s]*([0-9.-]+)', re.IGNORECASE),
+    re.compile(r'longitude["\s]*:[\s]*([0-9.-]+)', re.IGNORECASE),
+    re.compile(r'"lng"\s*:\s*([0-9.-]+)', re.IGNORECASE),
+]
+
+LEGACY_RADIUS_PATTERNS = [
+    re.compile(r'filter_radius_km["\s]*:[\s]*([0-9]+)', re.IGNORECASE),
+    re.compile(r'radius["\s]*:[\s]*([0-9]+)', re.IGNORECASE),
+]
+
+# Size of the generated page used when no captured pages are given
+SYNTHETIC_PAGE_SIZE = 3 * 1024 * 1024
+
+
+def legacy_extract_browse_params(page_content):
+    for pattern in LEGACY_BROWSE_PARAM_PATTERNS:
+        for match in pattern.findall(page_content):
+            try:
+                params = json.loads('{' + match + '}')
+                if 'filter_location_latitude' in params and 'filter_location_longitude' in params:
+                    return params
+            except (json.JSONDecodeError, TypeError):
+                continue
+
+    def first(patterns, cast):
+        for pattern in patterns:
+            match = pattern.search(page_content)
+            if match:
+                return cast(match.group(1))
+        return None
+
+    latitude = first(LEGACY_LAT_PATTERNS, float)
+    longitude = first(LEGACY_LON_PATTERNS, float)
+    radius = first(LEGACY_RADIUS_PATTERNS, int) or 500
+    if latitude is not None and longitude is not None:
+        return {"filter_location_latitude": latitude, "filter_location_longitude": longitude,
+                "filter_radius_km": radius}
+    return None
+
+
+def synthetic_page(size=SYNTHETIC_PAGE_SIZE, escaped=True):
+    """
+    A marketplace-like page: bundle scripts, then relay data with the params
+    near the end, embedded as an escaped JSON string as in the real HTML (or
+    as plain JSON with escaped=False).
+    """
+    params = {
+        "commerce_enable_local_pickup": True,
+        "commerce_search_and_rp_category_id": [],
+        "filter_location_latitude": 24.37,
+        "filter_location_longitude": 88.6,
+        "filter_radius_km": 65,
+        "filter_price_lower_bound": 0,
+        "filter_price_upper_bound": 214748364700,
+    }
+    head = "<html><head>" + "".join(
+        f'<script src="https://static.xx.fbcdn.net/rsrc.php/v4/y{i}/r/b{i}.js"></script>' for i in range(40)
+    ) + "</head><body>"
+    filler = '<script>requireLazy(["ScheduledServerJS"],function(s){s.handle({"require":[["Relay",{"id":42}]]})});</script>'
+    if escaped:
+        blob = '<script>__bbox("' + json.dumps({"browse_request_params": params}).replace('"', '\\"') + '")</script>'
+    else:
+        blob = '<script>__bbox(' + json.dumps({"browse_request_params": params}) + ')</script>'
+    body = filler * ((size - len(head) - len(blob)) // len(filler))
+    return head + body + blob + "</body></html>"
+
+
+def bench(extract, page_content, rounds):
+    """Best of rounds wall time (ms) and the result of one extraction."""
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = extract(page_content)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+
+def main(paths, rounds=5):
+    if paths:
+        pages = []
+        for path in paths:
+            with open(path, encoding="utf-8", errors="replace") as f:
+                pages.append((path, f.read()))
+    else:
+        pages = [("synthetic, escaped", synthetic_page()), ("synthetic, plain", synthetic_page(escaped=False))]
+
+    for name, page_content in pages:
+        legacy_ms, legacy = bench(legacy_extract_browse_params, page_content, rounds)
+        scanner_ms, scanned = bench(extract_browse_params, page_content, rounds)
+        location = scanned and (scanned["filter_location_latitude"], scanned["filter_location_longitude"],
+                                scanned["filter_radius_km"])
+        legacy_location = legacy and (legacy["filter_location_latitude"], legacy["filter_location_longitude"],
+                                      legacy["filter_radius_km"])
+        print(f"{name} ({len(page_content) / 1024:.0f} KB): regex cascade {legacy_ms:.1f} ms, "
+              f"scanner {scanner_ms:.1f} ms ({legacy_ms / max(scanner_ms, 1e-6):.1f}x)")
+        print(f"  scanner: {location}, regex cascade: {legacy_location}")
+
+
+if __name__ == "__main__":
+    # python benchmark_browse_params.py [captured_page.html ...]
+    main(sys.argv[1:])
@@ -0,0 +1,317 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Location of the on-disk cache shared by every scraper process on this machine
+CACHE_PATH = os.environ.get(
+    "FB_MARKETPLACE_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "marketplace.db")
+)
+
+# Persisted query ids only change when Facebook ships a new frontend build
+DOC_ID_TTL = 12 * 60 * 60
+
+# Which bundles held which operations changes far less often than the ids themselves
+BUNDLE_INDEX_TTL = 30 * 24 * 60 * 60
+
+# Browse params only depend on the marketplace location
+BROWSE_PARAMS_TTL = 24 * 60 * 60
+
+# Learnt GraphQL page size limits are re-probed after this long
+PAGE_SIZE_TTL = 24 * 60 * 60
+
+# Scrape results are served from memory (and the shared cache) for this long
+RESULT_TTL = 5 * 60
+
+# The shared cache file is trimmed back under this size, soonest-to-expire entries first
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+
+# Eviction runs on roughly one write in this many
+EVICT_EVERY = 50
+
+# Requested item counts are rounded up to one of these before scraping
+RESULT_BUCKETS = (10, 25, 50, 100)
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS cache ("
+    " namespace TEXT NOT NULL,"
+    " key TEXT NOT NULL,"
+    " value TEXT NOT NULL,"
+    " expires_at REAL,"
+    " PRIMARY KEY (namespace, key))",
+    "CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)",
+)
+
+
+def thread_connection(local, path, schema, row_factory=None):
+    """
+    Return the SQLite connection for path owned by the current thread and
+    process, keeping it on local (a threading.local), so connections are never
+    shared between threads or inherited across a fork.
+
+    A new connection runs in autocommit WAL mode, safe for several processes,
+    and runs the SQL statements in schema.
+    """
+    conn = getattr(local, "conn", None)
+    if conn is not None and local.pid == os.getpid():
+        return conn
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+    if row_factory is not None:
+        conn.row_factory = row_factory
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    for statement in schema:
+        conn.execute(statement)
+    local.conn = conn
+    local.pid = os.getpid()
+    return conn
+
+
+def _report_write_error(future):
+    if future.exception() is not None:
+        print(f"❌ Shared cache write failed: {future.exception()}")
+
+
+class SharedCache:
+    """
+    Key/value store with per-entry TTL backed by SQLite.
+
+    SQLite in WAL mode lets several processes (CLI runs, gunicorn workers)
+    read and write the same file safely. Every error is swallowed so a broken
+    cache only ever costs a cache miss.
+
+    Readers are never blocked by another process's write lock, but writers
+    wait for it, so code running on an event loop writes through set_soon
+    or submit.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_bytes=MAX_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._writes = 0
+        self._writer = None
+        self._writer_pid = None
+
+    def _connect(self):
+        return thread_connection(self._local, self.path, SCHEMA)
+
+    def get(self, namespace, key):
+        """Return the cached value, or None if it is missing or expired."""
+        try:
+            row = self._connect().execute(
+                "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?",
+                (namespace, key)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            return None
+        return json.loads(value)
+
+    def set(self, namespace, key, value, ttl=None):
+        """Store a JSON-serialisable value, optionally expiring after ttl seconds."""
+        expires_at = time.time() + ttl if ttl else None
+        try:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value), expires_at)
+            )
+        except sqlite3.Error:
+            return
+
+        self._writes += 1
+        if self._writes % EVICT_EVERY == 0:
+            self.evict()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Call fn(*args, **kwargs) on this process's writer thread when an event
+        loop is running, or right away otherwise. Submitted calls run one at a
+        time in submission order.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            fn(*args, **kwargs)
+            return
+
+        # A forked worker does not inherit the parent's thread
+        if self._writer_pid != os.getpid():
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-cache")
+            self._writer_pid = os.getpid()
+        self._writer.submit(fn, *args, **kwargs).add_done_callback(_report_write_error)
+
+    def set_soon(self, namespace, key, value, ttl=None):
+        """set() without blocking the running event loop, see submit."""
+        self.submit(self.set, namespace, key, value, ttl)
+
+    def evict(self):
+        """Drop expired entries, then the soonest-to-expire ones until the cache fits in max_bytes."""
+        try:
+            conn = self._connect()
+            conn.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+
+            total = conn.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM cache").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+
+            # Entries without a TTL sort last, so long-lived metadata outlives bulky results
+            rows = conn.execute(
+                "SELECT namespace, key, LENGTH(value) FROM cache "
+                "ORDER BY expires_at IS NULL, expires_at"
+            ).fetchall()
+            doomed = []
+            for namespace, key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                doomed.append((namespace, key))
+                total -= size
+            conn.executemany("DELETE FROM cache WHERE namespace = ? AND key = ?", doomed)
+        except sqlite3.Error:
+            pass
+
+    def delete(self, namespace, key, value=None):
+        """
+        Remove an entry. When value is given the entry is only removed if it
+        still holds that value, so one process cannot throw away a fresh entry
+        another process has just written.
+        """
+        try:
+            if value is None:
+                self._connect().execute(
+                    "DELETE FROM cache WHERE namespace = ? AND key = ?",
+                    (namespace, key)
+                )
+            else:
+                self._connect().execute(
+                    "DELETE FROM cache WHERE namespace = ? AND key = ? AND value = ?",
+                    (namespace, key, json.dumps(value))
+                )
+        except sqlite3.Error:
+            pass
+
+
+shared_cache = SharedCache()
+
+
+class ResultCache:
+    """
+    Bounded in-process LRU of scrape results with a TTL and single-flight coalescing.
+
+    Results are keyed by (query, location id) and remember how many items
+    were asked for, rounded up to a RESULT_BUCKETS size. A request for fewer
+    items than a cached (or in-flight) scrape is answered from that scrape, and
+    concurrent identical requests share one scrape. Must be used from a single
+    event loop.
+
+    With shared set to a SharedCache, results are also written to it and read
+    from it on a memory miss, so every worker on the host reuses them.
+    """
+
+    def __init__(self, max_entries=256, ttl=RESULT_TTL, shared=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self._entries = OrderedDict()  # (query, location_id) -> (expires_at, max_items, listings)
+        self._in_flight = {}  # (query, location_id) -> (max_items, task)
+
+    @staticmethod
+    def bucket(max_items):
+        """Round max_items up to the nearest bucket size."""
+        for size in RESULT_BUCKETS:
+            if max_items <= size:
+                return size
+        return max_items
+
+    def get(self, key, max_items):
+        """Return up to max_items cached listings for key, or None on a miss."""
+        entry = self._entries.get(key)
+        if entry is None and self.shared is not None:
+            entry = self._load_shared(key)
+        if entry is None:
+            return None
+
+        expires_at, scraped_items, listings = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+
+        # A short result means the search was exhausted, so it covers any size
+        if scraped_items < max_items and len(listings) >= scraped_items:
+            return None
+
+        self._entries.move_to_end(key)
+        return listings[:max_items]
+
+    def set(self, key, max_items, listings):
+        self._remember(key, time.monotonic() + self.ttl, max_items, listings)
+        if self.shared is not None:
+            self.shared.set_soon("results", json.dumps(key), {
+                "max_items": max_items,
+                "listings": listings,
+                "expires_at": time.time() + self.ttl,
+            }, ttl=self.ttl)
+
+    def _remember(self, key, expires_at, max_items, listings):
+        self._entries[key] = (expires_at, max_items, listings)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load_shared(self, key):
+        """Pull a result another worker stored into memory, or return None."""
+        value = self.shared.get("results", json.dumps(key))
+        if value is None:
+            return None
+        # Keep the remaining lifetime of the shared entry rather than starting a fresh TTL
+        expires_at = time.monotonic() + value["expires_at"] - time.time()
+        self._remember(key, expires_at, value["max_items"], value["listings"])
+        return self._entries[key]
+
+    async def get_or_scrape(self, query, location_id, max_items, scrape):
+        """
+        Return up to max_items listings for query at location_id.
+        scrape(query, max_items) is only awaited when neither the cache nor an
+        in-flight scrape can answer the request.
+        """
+        key = (query.strip().lower(), location_id)
+
+        listings = self.get(key, max_items)
+        if listings is not None:
+            return listings
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is None or in_flight[0] < max_items:
+            scraped_items = self.bucket(max_items)
+            task = asyncio.ensure_future(self._scrape(key, query, scraped_items, scrape))
+            in_flight = (scraped_items, task)
+            self._in_flight[key] = in_flight
+
+        # shield so one caller going away does not cancel the scrape for the others
+        listings = await asyncio.shield(in_flight[1])
+        return listings[:max_items]
+
+    async def _scrape(self, key, query, max_items, scrape):
+        try:
+            listings = await scrape(query, max_items)
+            if listings:
+                self.set(key, max_items, listings)
+            return listings
+        finally:
+            if self._in_flight.get(key, (None, None))[1] is asyncio.current_task():
+                del self._in_flight[key]
@@ -0,0 +1,77 @@
+import os
+import json
+import time
+
+# Save the checkpoint after this many pages or seconds, whichever comes first
+CHECKPOINT_EVERY = 5
+CHECKPOINT_INTERVAL = 30.0
+
+
+class Checkpoint:
+    """
+    Resume state for a long scrape, kept in a small JSON file.
+
+    For every URL it records the cursor of the next search page, the browse
+    params and doc_id in use, whether pagination finished, and the IDs of the
+    listings already emitted. The per-URL dicts are handed to
+    search.iter_search_pages, which keeps cursor/doc_id/done up to date;
+    page_done() then records the emitted IDs and saves periodically.
+
+    The file is replaced atomically, and the output writer is flushed first,
+    so everything the checkpoint claims was emitted is already on disk.
+    """
+
+    def __init__(self, path, writer=None, save_every=CHECKPOINT_EVERY, save_interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.writer = writer
+        self.save_every = save_every
+        self.save_interval = save_interval
+        self.urls = {}  # url -> state dict
+        self._unsaved = 0
+        self._last_save = time.monotonic()
+
+    @classmethod
+    def load(cls, path, writer=None):
+        """Read path, or start an empty checkpoint if it does not exist or is unreadable."""
+        checkpoint = cls(path, writer=writer)
+        try:
+            with open(path, encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return checkpoint
+
+        for url, state in saved.get("urls", {}).items():
+            state["emitted"] = set(state.get("emitted", []))
+            checkpoint.urls[url] = state
+        return checkpoint
+
+    def url_state(self, url):
+        """The mutable resume state of url."""
+        if url not in self.urls:
+            self.urls[url] = {"cursor": None, "browse_params": None, "doc_id": None, "done": False, "emitted": set()}
+        return self.urls[url]
+
+    def page_done(self, url, listing_ids):
+        """Record a page whose listings were handed to the writer, saving every few pages."""
+        self.url_state(url)["emitted"].update(listing_ids)
+        self._unsaved += 1
+        if self._unsaved >= self.save_every or time.monotonic() - self._last_save >= self.save_interval:
+            self.save()
+
+    def save(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+        urls = {
+            url: {**state, "emitted": sorted(state["emitted"])}
+            for url, state in self.urls.items()
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"saved_at": time.time(), "urls": urls}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        self._unsaved = 0
+        self._last_save = time.monotonic()
@@ -0,0 +1,277 @@
+import time
+import codecs
+import asyncio
+import weakref
+import aiohttp
+from scheduler import TokenBucket
+from cache import shared_cache, BROWSE_PARAMS_TTL, PAGE_SIZE_TTL
+from helper import (
+    PageScan, extract_browse_params, location_id_from_url, get_cached_doc_id,
+    discover_doc_ids, refresh_doc_id
+)
+
+GRAPHQL_URL = 'https://www.facebook.com/api/graphql/'
+
+# Per-request timeouts (seconds)
+PAGE_TIMEOUT = 8
+GRAPHQL_TIMEOUT = 8
+
+# Learnt page sizes are re-read from the shared cache this often (seconds), so a
+# limit another process recorded is picked up and an expired one is probed again
+PAGE_SIZE_RECHECK = 5 * 60
+
+# A re-discovery that found no different doc_id is not repeated for the same id for this long (seconds)
+REFRESH_RETRY_AFTER = 15 * 60
+
+# Marketplace pages are read in chunks of this size and dropped once scanned far enough
+PAGE_CHUNK_SIZE = 16 * 1024
+
+# Request budget per endpoint class: (requests per second, burst). Every
+# coroutine using a client shares its buckets, so many URLs at once still
+# stay inside this envelope; override with MarketplaceClient(rate_limits=...)
+RATE_LIMITS = {
+    "graphql": (25, 50),  # search pages and PDPs
+    "html": (5, 5),  # marketplace and listing pages
+    "bundle": (50, 25),  # static JS bundles swept for doc_ids
+}
+
+
+class MarketplaceClient:
+    """
+    Long-lived engine shared by every scrape in a process.
+
+    Owns a single pooled aiohttp session (DNS cache, keep-alive, per-host
+    limits) so repeat requests to facebook.com and fbcdn reuse connections,
+    token buckets that pace every request by endpoint class, plus in-memory
+    doc_id and browse-params caches in front of the on-disk cache shared with
+    the other processes on the host.
+    """
+
+    def __init__(self, cookies=None, proxy_url=None, limit=100, limit_per_host=20, rate_limits=None):
+        self.cookies = cookies or {}
+        self.proxy_url = proxy_url
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.doc_ids = {}  # doc_type -> doc_id
+        self.browse_params = {}  # location id -> browse_request_params
+        self.page_sizes = {}  # operation -> (largest page size the endpoint honours or None, when read)
+        self._refreshing = {}  # doc_type -> in-flight re-discovery task
+        self._refreshed = {}  # doc_type -> {stale doc_id: (what re-discovering it gave, when)}
+        self.rate_limits = {
+            endpoint: TokenBucket(rate, burst)
+            for endpoint, (rate, burst) in {**RATE_LIMITS, **(rate_limits or {})}.items()
+        }
+        self._session = None
+
+    @property
+    def session(self):
+        """The pooled session, created on first use inside the running event loop."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+                enable_cleanup_closed=True,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, cookies=self.cookies)
+        return self._session
+
+    @property
+    def closed(self):
+        return self._session is not None and self._session.closed
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def fetch_page(self, url, headers, timeout=PAGE_TIMEOUT, browse_params=True, bundles=True):
+        """
+        GET a marketplace page and return its HTML. Raises on HTTP errors.
+
+        The page is scanned as it streams in (see helper.PageScan) and the
+        connection is dropped as soon as it holds what the caller asked for:
+        the browse_request_params blob and/or the <head> bundle list. The
+        returned HTML then stops there; with both False the whole page is read.
+        """
+        await self.rate_limits["html"].acquire()
+        async with self.session.get(url, headers=headers, proxy=self.proxy_url,
+                                    timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            response.raise_for_status()
+            if not (browse_params or bundles):
+                return await response.text()
+
+            scan = PageScan(browse_params=browse_params, bundles=bundles)
+            decoder = codecs.getincrementaldecoder(response.charset or "utf-8")(errors="replace")
+            async for chunk in response.content.iter_chunked(PAGE_CHUNK_SIZE):
+                if scan.feed(decoder.decode(chunk)):
+                    # Drop the connection instead of downloading the rest of the page
+                    response.close()
+                    break
+            else:
+                scan.feed(decoder.decode(b"", final=True))
+            return scan.text
+
+    async def graphql(self, data, headers, timeout=GRAPHQL_TIMEOUT):
+        """POST a GraphQL request and return the decoded JSON. Raises on HTTP or JSON errors."""
+        await self.rate_limits["graphql"].acquire()
+        async with self.session.post(GRAPHQL_URL, headers=headers, data=data, proxy=self.proxy_url,
+                                     timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            response.raise_for_status()
+            # Facebook sometimes returns JSON with text/html content-type
+            return await response.json(content_type=None)
+
+    def cached_doc_id(self, doc_type="search"):
+        """Return a doc_id from memory or the on-disk cache without touching the network."""
+        doc_id = self.doc_ids.get(doc_type) or get_cached_doc_id(doc_type)
+        if doc_id:
+            self.doc_ids[doc_type] = doc_id
+        return doc_id
+
+    async def discover_doc_ids(self, page_content, headers):
+        """Sweep page_content's bundles for every doc_id missing from the caches."""
+        doc_ids = await discover_doc_ids(page_content, headers, proxy_url=self.proxy_url, session=self.session,
+                                         throttle=self.rate_limits["bundle"].acquire)
+        self.doc_ids.update(doc_ids)
+        return doc_ids
+
+    def _recent_refresh(self, doc_type, doc_id):
+        """(result, when) of re-discovering doc_id within REFRESH_RETRY_AFTER, or None."""
+        refresh = self._refreshed.get(doc_type, {}).get(doc_id)
+        if refresh and time.monotonic() - refresh[1] < REFRESH_RETRY_AFTER:
+            return refresh
+        return None
+
+    def refresh_failed(self, doc_type, doc_id):
+        """True if re-discovering doc_id recently found no usable id at all."""
+        refresh = self._recent_refresh(doc_type, doc_id)
+        return refresh is not None and refresh[0] is None
+
+    async def refresh_doc_id(self, page_content, headers, stale_doc_id, doc_type="search", url=None):
+        """
+        Replace a doc_id that a GraphQL call rejected, see helper.refresh_doc_id.
+
+        Single-flight: every coroutine that hits the same rotation waits on one
+        shared re-discovery, and one arriving after it finished gets the new id
+        straight away. Without page_content, url is fetched for its bundles.
+
+        A re-discovery that finds no different id is remembered for
+        REFRESH_RETRY_AFTER, so later calls for the same stale id return its
+        result (None, or the id itself) without fetching anything again.
+        """
+        current = self.doc_ids.get(doc_type)
+        if current and current != stale_doc_id:
+            return current
+
+        refresh = self._recent_refresh(doc_type, stale_doc_id)
+        if refresh:
+            return refresh[0]
+
+        task = self._refreshing.get(doc_type)
+        if task is None:
+            task = asyncio.ensure_future(self._refresh_doc_id(page_content, headers, stale_doc_id, doc_type, url))
+            self._refreshing[doc_type] = task
+
+            def forget(done, doc_type=doc_type):
+                if self._refreshing.get(doc_type) is done:
+                    del self._refreshing[doc_type]
+            task.add_done_callback(forget)
+
+        # One waiter being cancelled must not cancel the shared re-discovery
+        return await asyncio.shield(task)
+
+    async def _refresh_doc_id(self, page_content, headers, stale_doc_id, doc_type, url):
+        doc_id = None
+        if page_content is None and url:
+            try:
+                page_content = await self.fetch_page(url, headers, browse_params=False)
+            except Exception as e:
+                print(f"❌ Error fetching {url} to rediscover the {doc_type} doc_id: {e}")
+                page_content = None
+
+        if page_content is not None:
+            doc_id = await refresh_doc_id(page_content, headers, stale_doc_id, doc_type=doc_type,
+                                          proxy_url=self.proxy_url, session=self.session,
+                                          throttle=self.rate_limits["bundle"].acquire)
+
+        if doc_id and doc_id != stale_doc_id:
+            self.doc_ids[doc_type] = doc_id
+        else:
+            # Nothing new: None if no id was found, stale_doc_id if the bundles confirmed it
+            self._refreshed.setdefault(doc_type, {})[stale_doc_id] = (doc_id, time.monotonic())
+        return doc_id
+
+    def cached_browse_params(self, location_id):
+        """Return browse params for location_id from memory or the shared cache, or None."""
+        if not location_id:
+            return None
+
+        browse_params = self.browse_params.get(location_id) or shared_cache.get("browse_params", location_id)
+        if browse_params:
+            self.browse_params[location_id] = browse_params
+        return browse_params
+
+    def get_browse_params(self, url, page_content):
+        """Return browse_request_params for url's location, parsing page_content on a miss."""
+        location_id = location_id_from_url(url)
+        browse_params = self.cached_browse_params(location_id)
+        if browse_params:
+            return browse_params
+
+        browse_params = extract_browse_params(page_content)
+        if browse_params and location_id:
+            self.browse_params[location_id] = browse_params
+            shared_cache.set_soon("browse_params", location_id, browse_params, ttl=BROWSE_PARAMS_TTL)
+        return browse_params
+
+    def page_size(self, operation, default):
+        """The learnt page size limit of operation, or default while none is known."""
+        page_size, read_at = self.page_sizes.get(operation, (None, None))
+        if read_at is None or time.monotonic() - read_at > PAGE_SIZE_RECHECK:
+            page_size = shared_cache.get("page_size", operation)
+            self.page_sizes[operation] = (page_size, time.monotonic())
+        return page_size or default
+
+    def set_page_size(self, operation, page_size):
+        """Remember the page size limit of operation for this and every other process."""
+        self.page_sizes[operation] = (page_size, time.monotonic())
+        shared_cache.set_soon("page_size", operation, page_size, ttl=PAGE_SIZE_TTL)
+
+    async def warm_up(self, url, headers, doc_types=("search",)):
+        """
+        Load the doc_ids for doc_types and url's browse params into memory,
+        fetching url and sweeping its bundles only for what the caches do not
+        already hold. Returns True once the search doc_id and the browse params
+        are available.
+        """
+        location_id = location_id_from_url(url)
+        need_browse_params = not self.cached_browse_params(location_id)
+        need_doc_ids = not all(self.cached_doc_id(doc_type) for doc_type in doc_types)
+
+        if need_browse_params or need_doc_ids:
+            page_content = await self.fetch_page(url, headers, browse_params=need_browse_params,
+                                                 bundles=need_doc_ids)
+            if need_browse_params:
+                self.get_browse_params(url, page_content)
+            if need_doc_ids:
+                await self.discover_doc_ids(page_content, headers)
+
+        return bool(self.cached_doc_id("search") and self.cached_browse_params(location_id))
+
+
+_clients = weakref.WeakKeyDictionary()
+
+def get_client(cookies=None, proxy_url=None):
+    """Return the process-wide client for the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.closed:
+        client = MarketplaceClient(cookies=cookies, proxy_url=proxy_url)
+        _clients[loop] = client
+    return client
@@ -0,0 +1,29 @@
+# gunicorn picks this file up automatically: gunicorn app:app
+# Threaded workers let one worker serve many requests, whose scrapes all run
+# concurrently on the worker's shared event loop (see background.BackgroundLoop).
+worker_class = "gthread"
+workers = 2
+threads = 16
+timeout = 150
+
+
+def on_starting(server):
+    """Discover doc_ids and browse params once in the master, before any worker forks."""
+    import asyncio
+    from client import MarketplaceClient
+    from scraper import warm_up, get_proxy_url, COOKIES
+
+    async def run():
+        async with MarketplaceClient(cookies=COOKIES, proxy_url=get_proxy_url(for_aiohttp=True)) as client:
+            return await warm_up(client=client)
+
+    try:
+        asyncio.run(run())
+    except Exception as e:
+        server.log.warning(f"Warm-up in master failed: {e}")
+
+
+def post_worker_init(worker):
+    """Load the master's results from the shared cache into the worker's memory."""
+    from app import start_warm_up
+    start_warm_up()
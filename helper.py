@@ -2,73 +2,92 @@ import re
 import aiohttp
 import asyncio
 import json
+from urllib.parse import urlparse
+from cache import shared_cache, DOC_ID_TTL, BUNDLE_INDEX_TTL
 
-# Pre-compiled regex patterns for better performance
-BROWSE_PARAM_PATTERNS = [
-    re.compile(r'browse_request_params["\s]*:[\s]*({[^}]*})', re.IGNORECASE | re.DOTALL),
-    re.compile(r'browse_request_params\s*:\s*({[^}]*})', re.IGNORECASE | re.DOTALL),
-    re.compile(r'"browse_request_params"\s*:\s*({[^}]*})', re.IGNORECASE | re.DOTALL),
-    re.compile(r'browse_request_params"\s*:\s*\{([^}]*)\}', re.IGNORECASE | re.DOTALL),
-]
-
-LAT_PATTERNS = [
-    re.compile(r'filter_location_latitude["\s]*:[\s]*([0-9.-]+)', re.IGNORECASE),
-    re.compile(r'latitude["\s]*:[\s]*([0-9.-]+)', re.IGNORECASE),
-    re.compile(r'"lat"\s*:\s*([0-9.-]+)', re.IGNORECASE),
-]
-
-LON_PATTERNS = [
-    re.compile(r'filter_location_longitude["\s]*:[\s]*([0-9.-]+)', re.IGNORECASE),
-    re.compile(r'longitude["\s]*:[\s]*([0-9.-]+)', re.IGNORECASE),
-    re.compile(r'"lng"\s*:\s*([0-9.-]+)', re.IGNORECASE),
-]
-
-RADIUS_PATTERNS = [
-    re.compile(r'filter_radius_km["\s]*:[\s]*([0-9]+)', re.IGNORECASE),
-    re.compile(r'radius["\s]*:[\s]*([0-9]+)', re.IGNORECASE),
-]
+MARKETPLACE_LOCATION_PATTERN = re.compile(r'/marketplace/(\d+)')
+
+# Script bundles a marketplace page loads, swept for GraphQL doc_ids
+JS_URL_PATTERN = re.compile(r'https?://static\.xx\.fbcdn\.net/rsrc\.php/[^"\s]+\.js')
+
+HEAD_END_PATTERN = re.compile(r'</head\s*>', re.IGNORECASE)
+
+BROWSE_PARAMS_KEY = "browse_request_params"
+
+# What may sit between a key and its value: quotes (escaped or not), colon, whitespace
+KEY_SEPARATOR = re.compile(r'[\s"\\:]*')
+
+# One pass over the page finds the params key and the location fields used as a fallback.
+# Matches start at the "_" after "browse"/"filter": a literal first character lets
+# the regex engine skip ahead with a fast search instead of trying every position
+BROWSE_PARAMS_SCAN = re.compile(r'_(?:(?<=browse_)request_params'
+                                r'|(?<=filter_)(?:location_latitude|location_longitude|radius_km))')
+BROWSE_PARAMS_SCAN_PREFIX = len("browse")  # == len("filter")
+
+LOCATION_FIELD_VALUE = re.compile(r'-?\d+(?:\.\d+)?')
+
+# Body of a JS string literal, for params embedded with escaped quotes
+JS_STRING_BODY = re.compile(r'(?:[^"\\]|\\.)*', re.DOTALL)
+
+# Longest stretch after a browse_request_params key waited through for its object to close
+MAX_BROWSE_PARAMS_SPAN = 16 * 1024
+
+JSON_DECODER = json.JSONDecoder()
+
+# GraphQL operation names for each supported doc_type
+DOC_ID_OPERATIONS = {
+    "search": "CometMarketplaceSearchContentPaginationQuery",
+    "pdp": "MarketplacePDPContainerQuery",
+}
+
+# Fragments of GraphQL error messages returned for an unknown persisted query
+STALE_DOC_ID_MARKERS = ("persistedquerynotfound", "persisted query", "doc_id", "document_id")
+
+def is_browse_params(params):
+    """True for a decoded browse_request_params object the search can use, i.e. one with a location."""
+    return (isinstance(params, dict)
+            and 'filter_location_latitude' in params and 'filter_location_longitude' in params)
+
+def browse_params_at(page_content, position):
+    """
+    Decode the JSON object following the browse_request_params key that ends
+    at position, written either as plain JSON or inside a JS string with
+    escaped quotes. Returns None if there is no complete object there.
+    """
+    separator = KEY_SEPARATOR.match(page_content, position)
+    start = separator.end()
+    if not page_content.startswith("{", start):
+        return None
+
+    text = page_content
+    try:
+        if "\\" in separator.group():
+            body = JS_STRING_BODY.match(page_content, start, start + MAX_BROWSE_PARAMS_SPAN).group()
+            text, start = json.loads('"' + body + '"'), 0
+        params, _ = JSON_DECODER.raw_decode(text, start)
+    except ValueError:
+        return None
+    return params if isinstance(params, dict) else None
 
 def extract_browse_params(page_content):
-    """Extract browse_request_params from the marketplace page HTML using pre-compiled patterns."""
-    # Try multiple patterns to find the browse_request_params
-    for pattern in BROWSE_PARAM_PATTERNS:
-        matches = pattern.findall(page_content)
-        for match in matches:
-            try:
-                # Try to parse as JSON
-                params_str = '{' + match + '}'
-                params = json.loads(params_str)
-
-                # Check if it has the expected structure
-                if 'filter_location_latitude' in params and 'filter_location_longitude' in params:
-                    return params
-            except (json.JSONDecodeError, TypeError):
-                continue
-
-    # Try to find individual location parameters using pre-compiled patterns
-    latitude = None
-    longitude = None
-    radius = 500
-
-    for pattern in LAT_PATTERNS:
-        match = pattern.search(page_content)
-        if match:
-            latitude = float(match.group(1))
-            break
-
-    for pattern in LON_PATTERNS:
-        match = pattern.search(page_content)
-        if match:
-            longitude = float(match.group(1))
-            break
-
-    for pattern in RADIUS_PATTERNS:
-        match = pattern.search(page_content)
-        if match:
-            radius = int(match.group(1))
-            break
-
-    if latitude is not None and longitude is not None:
+    """
+    Extract browse_request_params from the marketplace page HTML in a single
+    pass: the first browse_request_params object with a location wins, and
+    without one the filter_location_* fields seen along the way are used.
+    """
+    fields = {}
+    for match in BROWSE_PARAMS_SCAN.finditer(page_content):
+        key = page_content[match.start() - BROWSE_PARAMS_SCAN_PREFIX:match.end()]
+        if key == BROWSE_PARAMS_KEY:
+            params = browse_params_at(page_content, match.end())
+            if is_browse_params(params):
+                return params
+        elif key not in fields:
+            value = LOCATION_FIELD_VALUE.match(page_content, KEY_SEPARATOR.match(page_content, match.end()).end())
+            if value:
+                fields[key] = float(value.group())
+
+    if 'filter_location_latitude' in fields and 'filter_location_longitude' in fields:
         return {
             "commerce_enable_local_pickup": True,
             "commerce_enable_shipping": True,
@@ -76,76 +95,345 @@ def extract_browse_params(page_content):
             "commerce_search_and_rp_category_id": [],
             "commerce_search_and_rp_condition": None,
             "commerce_search_and_rp_ctime_days": None,
-            "filter_location_latitude": latitude,
-            "filter_location_longitude": longitude,
+            "filter_location_latitude": fields['filter_location_latitude'],
+            "filter_location_longitude": fields['filter_location_longitude'],
             "filter_price_lower_bound": 0,
             "filter_price_upper_bound": 214748364700,
-            "filter_radius_km": radius
+            "filter_radius_km": int(fields.get('filter_radius_km', 500))
         }
 
     return None
 
-async def extract_marketplace_doc_id(page_content, headers, doc_type="search", proxy_url=None):
+def location_id_from_url(url):
+    """Return the location id from a marketplace URL such as /marketplace/113520048658655/search, or None."""
+    match = MARKETPLACE_LOCATION_PATTERN.search(urlparse(url).path)
+    return match.group(1) if match else None
+
+class PageScan:
     """
-    Extract Facebook Marketplace GraphQL doc_id (async).
-    doc_type: "search" for CometMarketplaceSearchContentPaginationQuery or "pdp" for MarketplacePDPContainerQuery
-    Returns doc_id or None.
+    Incremental scan of a marketplace page as it downloads.
+
+    feed() takes the decoded text chunk by chunk and returns True once the
+    page holds everything asked for: a browse_request_params object that
+    extract_browse_params would accept (see is_browse_params) and/or the
+    bundle script list, which is done when </head> closes with at
+    least one bundle in it. Only the unscanned tail of the page is searched,
+    so a chunk costs the same wherever it falls in the page.
     """
-    js_urls = re.findall(
-        r'https?://static\.xx\.fbcdn\.net/rsrc\.php/[^"\s]+\.js',
-        page_content
-    )
+
+    def __init__(self, browse_params=True, bundles=True):
+        self.need_browse_params = browse_params
+        self.need_bundles = bundles
+        self.has_browse_params = False
+        self.has_bundles = False
+        self.head_done = False
+        self._chunks = []
+        self._head_tail = ""  # end of the previous chunk, for matches split across chunks
+        self._params_window = ""  # text from the first browse_request_params key not yet resolved
+
+    @property
+    def text(self):
+        return "".join(self._chunks)
+
+    @property
+    def complete(self):
+        browse_params_done = self.has_browse_params or not self.need_browse_params
+        bundles_done = (self.head_done and self.has_bundles) or not self.need_bundles
+        return browse_params_done and bundles_done
+
+    def feed(self, text):
+        """Add the next chunk of the page; returns True once the rest of it is not needed."""
+        self._chunks.append(text)
+
+        if not self.head_done:
+            window = self._head_tail + text
+            self.has_bundles = self.has_bundles or bool(JS_URL_PATTERN.search(window))
+            self.head_done = bool(HEAD_END_PATTERN.search(window))
+            self._head_tail = window[-512:]
+
+        if self.need_browse_params and not self.has_browse_params:
+            self._scan_browse_params(text)
+
+        return self.complete
+
+    def _scan_browse_params(self, text):
+        window = self._params_window + text
+        while True:
+            key = window.find(BROWSE_PARAMS_KEY)
+            if key < 0:
+                self._params_window = window[-len(BROWSE_PARAMS_KEY):]
+                return
+
+            params = browse_params_at(window, key + len(BROWSE_PARAMS_KEY))
+            if is_browse_params(params):
+                self.has_browse_params = True
+                self._params_window = ""
+                return
+            if params is None and len(window) - key < MAX_BROWSE_PARAMS_SPAN:
+                self._params_window = window[key:]  # the object may not have arrived or closed yet
+                return
+
+            # Not usable params (no location, or never closed): look past this key
+            window = window[key + len(BROWSE_PARAMS_KEY):]
+
+BUNDLE_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+# Bundles are streamed in chunks of this size instead of being read whole
+JS_CHUNK_SIZE = 64 * 1024
+
+# Longest stretch kept after a relay operation marker while waiting for its a.exports value
+MAX_DOC_ID_SPAN = 256 * 1024
+
+# Bundles the locality index points at get this long on their own before the rest are fetched
+LIKELY_BUNDLE_HEAD_START = 0.5
+
+# Bundle paths remembered per operation, most recent first
+MAX_BUNDLE_INDEX_ENTRIES = 20
+
+# Most bundles fetched by one doc_id sweep, likely ones included
+MAX_BUNDLES_PER_SWEEP = 20
+
+def rank_bundle_urls(js_urls, operations, limit=MAX_BUNDLES_PER_SWEEP):
+    """
+    Split bundle URLs into (likely, rest), at most limit in total, using the
+    bundle locality index. Likely bundles are exact path hits, most recently
+    recorded first; the rest keep page order.
+    """
+    rank = {}
+    for operation in operations:
+        entry = shared_cache.get("bundle_index", operation) or {}
+        for position, path in enumerate(entry.get("paths", [])):
+            rank[path] = min(position, rank.get(path, position))
+
+    likely, rest = [], []
+    for js_url in js_urls:
+        (likely if urlparse(js_url).path in rank else rest).append(js_url)
+    likely.sort(key=lambda js_url: rank[urlparse(js_url).path])
+
+    likely = likely[:limit]
+    return likely, rest[:limit - len(likely)]
+
+def record_bundle_locations(located):
+    """Remember which bundle each operation's doc_id was found in (operation -> bundle URL)."""
+    for operation, js_url in located.items():
+        path = urlparse(js_url).path
+        entry = shared_cache.get("bundle_index", operation) or {}
+        paths = [path] + [p for p in entry.get("paths", []) if p != path]
+        shared_cache.set("bundle_index", operation, {"paths": paths[:MAX_BUNDLE_INDEX_ENTRIES]},
+                         ttl=BUNDLE_INDEX_TTL)
+
+def compile_doc_id_patterns(operations):
+    """
+    Return (marker, pattern, overlap) for finding the doc_ids of several relay
+    operations in raw bundle bytes with one pass.
+    """
+    names = b"|".join(re.escape(operation.encode()) for operation in operations)
+    marker = re.compile(rb"(" + names + rb")_facebookRelayOperation")
+    pattern = re.compile(rb"(" + names + rb")_facebookRelayOperation.*?a\.exports\s*=\s*\"(\d+)\"")
+    overlap = max(len(operation) for operation in operations) + len("_facebookRelayOperation") - 1
+    return marker, pattern, overlap
+
+async def extract_marketplace_doc_ids(page_content, headers, operations=None, proxy_url=None, session=None,
+                                      throttle=None):
+    """
+    Sweep the page's JS bundles once for several GraphQL operations.
+    operations defaults to every operation in DOC_ID_OPERATIONS.
+    Bundles are fetched through session when given (normally the MarketplaceClient's
+    pooled session), otherwise through a temporary one. throttle, if given, is
+    awaited before each bundle request (e.g. a TokenBucket's acquire).
+    Returns a dict of operation name -> doc_id for the operations that were found.
+    """
+    operations = set(operations or DOC_ID_OPERATIONS.values())
+    found = {}
+
+    js_urls = JS_URL_PATTERN.findall(page_content)
 
     if not js_urls:
-        return None
+        return found
 
     print(f"Found {len(js_urls)} JS urls for doc_id extraction")
 
-    # Select pattern based on doc_type
-    if doc_type == "pdp":
-        pattern = re.compile(
-            r'MarketplacePDPContainerQuery_facebookRelayOperation'
-            r'.*?a\.exports\s*=\s*"(\d+)"'
-        )
-    else:  # default to search
-        pattern = re.compile(
-            r'CometMarketplaceSearchContentPaginationQuery_facebookRelayOperation'
-            r'.*?a\.exports\s*=\s*"(\d+)"'
+    # Bundles that held these operations before go first, the rest in page order
+    likely, rest = rank_bundle_urls(list(dict.fromkeys(js_urls)), operations)
+
+    if likely:
+        print(f"Trying {len(likely)} previously seen bundles first")
+
+    patterns = compile_doc_id_patterns(operations)
+    located = {}
+
+    own_session = session is None
+    if own_session:
+        session = aiohttp.ClientSession()
+
+    def start(js_url):
+        return asyncio.create_task(
+            check_js_file(session, js_url, headers, patterns, operations, found, located, proxy_url=proxy_url,
+                          throttle=throttle)
         )
 
-    timeout = aiohttp.ClientTimeout(total=10)
+    # Concurrent processing of JS files for better performance
+    pending = {start(js_url) for js_url in likely}
 
-    async with aiohttp.ClientSession(headers=headers, timeout=timeout) as session:
-        # Concurrent processing of JS files for better performance
-        tasks = []
-        for js_url in js_urls[:20]:  # Reduced from 40 to 20 for speed
-            tasks.append(check_js_file(session, js_url, pattern, proxy_url=proxy_url))
+    try:
+        # Give the likely bundles a head start before fetching the rest
+        loop = asyncio.get_running_loop()
+        head_start_ends = loop.time() + LIKELY_BUNDLE_HEAD_START
+        while pending and not operations <= found.keys() and loop.time() < head_start_ends:
+            done, pending = await asyncio.wait(
+                pending, timeout=head_start_ends - loop.time(), return_when=asyncio.FIRST_COMPLETED
+            )
 
-        # Wait for first successful result
-        for task in asyncio.as_completed(tasks):
-            try:
-                result = await task
-                if result:
-                    return result
-            except Exception:
-                continue
+        if not operations <= found.keys():
+            pending |= {start(js_url) for js_url in rest}
 
-    return None
+        # Wait until every operation has been found or all bundles are scanned
+        while pending and not operations <= found.keys():
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        # Stop every other bundle download as soon as we have an answer
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if own_session:
+            await session.close()
+
+    # The index update reads then writes, so all of it runs on the cache's writer thread
+    shared_cache.submit(record_bundle_locations, located)
+    return found
+
+async def extract_marketplace_doc_id(page_content, headers, doc_type="search", proxy_url=None, session=None):
+    """
+    Extract Facebook Marketplace GraphQL doc_id (async).
+    doc_type: "search" for CometMarketplaceSearchContentPaginationQuery or "pdp" for MarketplacePDPContainerQuery
+    Returns doc_id or None.
+    """
+    operation = DOC_ID_OPERATIONS.get(doc_type, DOC_ID_OPERATIONS["search"])
+    found = await extract_marketplace_doc_ids(page_content, headers, [operation], proxy_url=proxy_url, session=session)
+    return found.get(operation)
+
+async def scan_js_chunks(chunks, patterns, operations, found, located=None, source=None):
+    """
+    Search an async iterable of bundle chunks for the doc_ids of operations,
+    recording hits in found (and the source bundle of new hits in located).
+    Stops once found holds every operation, which may also be filled in by
+    scans of other bundles running concurrently.
+    Only a small overlap window is carried between chunks, or the text after the
+    earliest marker whose a.exports value may still be arriving.
+    """
+    marker, pattern, overlap = patterns
+    buffer = b""
+
+    async for chunk in chunks:
+        buffer += chunk
+
+        scanned = 0
+        for match in pattern.finditer(buffer):
+            operation = match.group(1).decode()
+            if operation in operations and operation not in found:
+                found[operation] = match.group(2).decode()
+                if located is not None:
+                    located[operation] = source
+            scanned = match.end()
 
-async def check_js_file(session, js_url, pattern, proxy_url=None):
-    """Check a single JS file for the doc_id pattern."""
+        if operations <= found.keys():
+            return True
+
+        # The pattern cannot cross a newline, so only markers after the last one can still match
+        newline = buffer.rfind(b"\n", scanned)
+        pending_marker = marker.search(buffer, max(scanned, newline + 1))
+        if pending_marker and len(buffer) - pending_marker.start() <= MAX_DOC_ID_SPAN:
+            buffer = buffer[pending_marker.start():]
+        else:
+            buffer = buffer[-overlap:]
+
+    return False
+
+async def check_js_file(session, js_url, headers, patterns, operations, found, located=None, proxy_url=None,
+                        throttle=None):
+    """Stream a single JS file, stopping as soon as every wanted doc_id has been found."""
     try:
-        async with session.get(js_url, proxy=proxy_url) as resp:
+        if throttle:
+            await throttle()
+        async with session.get(js_url, headers=headers, proxy=proxy_url, timeout=BUNDLE_TIMEOUT) as resp:
             if resp.status != 200:
                 print(f"JS fetch failed {resp.status} for {js_url}")
-                return None
-            text = await resp.text()
-            match = pattern.search(text)
-            return match.group(1) if match else None
+                return False
+            complete = await scan_js_chunks(
+                resp.content.iter_chunked(JS_CHUNK_SIZE), patterns, operations, found, located, js_url
+            )
+            if complete:
+                # Drop the connection instead of draining the rest of the bundle
+                resp.close()
+            return complete
     except Exception:
+        return False
+
+def get_cached_doc_id(doc_type="search"):
+    """Return the cached doc_id for doc_type without touching the network."""
+    return shared_cache.get("doc_id", DOC_ID_OPERATIONS[doc_type])
+
+async def discover_doc_ids(page_content, headers, proxy_url=None, session=None, throttle=None):
+    """
+    Find every registered operation missing from the cache in a single bundle
+    sweep and cache what was found.
+    Returns a dict of doc_type -> doc_id covering cached and newly found ids.
+    """
+    doc_ids = {doc_type: get_cached_doc_id(doc_type) for doc_type in DOC_ID_OPERATIONS}
+    missing = {DOC_ID_OPERATIONS[doc_type] for doc_type, doc_id in doc_ids.items() if not doc_id}
+
+    if missing and page_content:
+        found = await extract_marketplace_doc_ids(page_content, headers, missing, proxy_url=proxy_url, session=session,
+                                                  throttle=throttle)
+        for doc_type, operation in DOC_ID_OPERATIONS.items():
+            if operation in found:
+                doc_ids[doc_type] = found[operation]
+                shared_cache.set_soon("doc_id", operation, found[operation], ttl=DOC_ID_TTL)
+
+    return {doc_type: doc_id for doc_type, doc_id in doc_ids.items() if doc_id}
+
+async def refresh_doc_id(page_content, headers, stale_doc_id, doc_type="search", proxy_url=None, session=None,
+                         throttle=None):
+    """
+    Replace a doc_id that a GraphQL call rejected.
+    If another run has already cached a different id it is reused as is.
+    Otherwise page_content's bundles are swept for the operation and a
+    different id found there replaces the cached one. The cached id is only
+    replaced, never dropped: if the sweep finds nothing it stays in place for
+    every other process and None is returned.
+    """
+    current = get_cached_doc_id(doc_type)
+    if current and current != stale_doc_id:
+        return current
+
+    print(f"Cached {doc_type} doc_id {stale_doc_id} looks stale, rediscovering...")
+    operation = DOC_ID_OPERATIONS[doc_type]
+    found = {}
+    if page_content:
+        found = await extract_marketplace_doc_ids(page_content, headers, {operation}, proxy_url=proxy_url,
+                                                  session=session, throttle=throttle)
+
+    doc_id = found.get(operation)
+    if not doc_id:
+        print(f"Could not rediscover the {doc_type} doc_id, keeping {stale_doc_id}")
         return None
+    if doc_id != stale_doc_id:
+        shared_cache.set_soon("doc_id", operation, doc_id, ttl=DOC_ID_TTL)
+    return doc_id
+
+def is_stale_doc_id_response(response_data):
+    """Return True if a GraphQL response rejects the doc_id it was sent with."""
+    if not isinstance(response_data, dict) or response_data.get("data"):
+        return False
+
+    errors = response_data.get("errors")
+    if not errors:
+        return False
+
+    error_text = json.dumps(errors).lower()
+    return any(marker in error_text for marker in STALE_DOC_ID_MARKERS)
 
 # Backward compatibility
-async def extract_marketplace_pdp_doc_id(page_content, headers, proxy_url=None):
+async def extract_marketplace_pdp_doc_id(page_content, headers, proxy_url=None, session=None):
     """Backward compatibility wrapper for PDP doc_id extraction."""
-    return await extract_marketplace_doc_id(page_content, headers, doc_type="pdp", proxy_url=proxy_url)
+    return await extract_marketplace_doc_id(page_content, headers, doc_type="pdp", proxy_url=proxy_url, session=session)
@@ -1,9 +1,17 @@
-import aiohttp
+import os
 import json
 import asyncio
 from urllib.parse import urlparse, parse_qs
-from extractor import extract_marketplace_listings
-from helper import extract_marketplace_doc_id, extract_marketplace_pdp_doc_id, extract_browse_params
+from helper import is_stale_doc_id_response, location_id_from_url
+from search import iter_search_pages
+from tiles import iter_tiled_pages
+from client import MarketplaceClient, get_client
+from scheduler import AdaptiveLimiter, map_adaptive
+from output import NDJSONWriter, rebuild_grouped_json, iter_ndjson
+from checkpoint import Checkpoint
+from seen import SeenIndex, mostly_known
+from pdp_store import PDPStore, listing_fingerprint
+from storage import ListingStore
 
 
 # Configuration
@@ -13,7 +21,15 @@ config = {
         "https://www.facebook.com/marketplace/113520048658655/search?query=clothe"
     ],
     "deepScrape": False,  # If true, will visit details page and extract more information
-    "count": 100
+    "count": 100,
+    "output": "output.ndjson",  # One JSON listing per line, written as listings arrive
+    "groupedOutput": None,  # Set to e.g. "output.json" to also rebuild the grouped-by-query JSON at the end
+    "checkpoint": "checkpoint.json",  # Resume state for regular scrapes, saved every few pages
+    "resume": False,  # If true, continue each URL from the checkpoint and append to the output
+    "newOnly": False,  # If true, only emit listings no earlier run emitted and stop once pages are mostly known
+    "pdpMaxAge": 24 * 60 * 60,  # Deep scrape reuses stored details of unchanged listings up to this age in seconds (0 to always fetch)
+    "database": True,  # If true, also upsert every listing into the SQLite listings database (storage.py)
+    "geoTiles": False  # If true, split each search area into tiles paginated concurrently (tiles.py); not checkpointed
 }
 
 proxy = {
@@ -56,8 +72,15 @@ def extract_listing_from_pdp_response(detailed_data):
     recursive_search(detailed_data)
     return extracted_listings
 
-async def get_detailed_listing_data(session, listing_id, pdp_doc_id, proxy_url=None):
-    """Get detailed data for a specific listing using shared aiohttp session."""
+# PDP responses are larger than search pages
+PDP_TIMEOUT = 12
+
+async def get_detailed_listing_data(client, listing_id, pdp_doc_id, refresh_url=None):
+    """Get detailed data for a specific listing through the shared client, or None."""
+    # A re-discovery already found no PDP doc_id at all, so every request would be rejected
+    if client.refresh_failed("pdp", pdp_doc_id):
+        return None
+
     try:
         # Use the exact variables from the original working deep.py
         variables = {
@@ -85,23 +108,24 @@ async def get_detailed_listing_data(session, listing_id, pdp_doc_id, proxy_url=N
             'doc_id': pdp_doc_id,  # Use dynamically extracted doc_id
         }
 
-        # Use shared session for better performance
-        async with session.post('https://www.facebook.com/api/graphql/',
-                               headers=headers,
-                               data=data,
-                               proxy=proxy_url) as response:
-            if response.status == 200:
-                # Facebook sometimes returns JSON with text/html content-type
-                response_text = await response.text()
-                try:
-                    detailed_data = json.loads(response_text)
-                    return detailed_data
-                except json.JSONDecodeError:
-                    print(f"Failed to parse JSON response for listing {listing_id}: {response_text[:200]}...")
-                    return None
-            else:
-                print(f"HTTP {response.status} for listing {listing_id}")
-                return None
+        # Use the shared connection pool for better performance
+        try:
+            detailed_data = await client.graphql(data, headers, timeout=PDP_TIMEOUT)
+        except json.JSONDecodeError:
+            print(f"Failed to parse JSON response for listing {listing_id}")
+            return None
+
+        if is_stale_doc_id_response(detailed_data):
+            # Rediscover the PDP doc_id from refresh_url (once for all concurrent callers) and retry with it
+            if refresh_url:
+                refresh_headers = headers.copy()
+                refresh_headers['referer'] = refresh_url
+                new_doc_id = await client.refresh_doc_id(None, refresh_headers, pdp_doc_id, doc_type="pdp",
+                                                         url=refresh_url)
+                if new_doc_id and new_doc_id != pdp_doc_id:
+                    return await get_detailed_listing_data(client, listing_id, new_doc_id)
+            return None
+        return detailed_data
 
     except Exception as e:
         print(f"Exception getting detailed data for listing {listing_id}: {e}")
@@ -131,8 +155,14 @@ headers = {
     'x-fb-friendly-name': 'CometMarketplaceSearchContentPaginationQuery',
 }
 
-async def process_single_url(url, cached_doc_id, max_items=None):
-    """Process a single marketplace URL and return its listings."""
+async def iter_listings(url, cached_doc_id, max_items=None, client=None, state=None):
+    """
+    Yield a marketplace URL's listings one GraphQL page at a time, as each page
+    is parsed, so callers can work on a page while the next one is in flight.
+    With a checkpoint state (see checkpoint.Checkpoint) pagination continues
+    from its cursor with the browse params and doc_id it was using.
+    """
+    client = client or get_client(cookies, get_proxy_url(for_aiohttp=True))
 
     # Extract query from URL
     parsed = urlparse(url)
@@ -146,298 +176,296 @@ async def process_single_url(url, cached_doc_id, max_items=None):
     current_headers = headers.copy()
     current_headers['referer'] = url
 
-    # Get marketplace page HTML
-    print("Fetching marketplace page...")
-    try:
-        timeout = aiohttp.ClientTimeout(total=8)  # Reduced timeout
-        proxy_url = get_proxy_url(for_aiohttp=True)
-        connector = aiohttp.TCPConnector() if proxy_url is None else aiohttp.TCPConnector()
-
-        async with aiohttp.ClientSession(timeout=timeout, cookies=cookies, connector=connector) as session:
-            async with session.get(url, headers=current_headers, proxy=proxy_url) as response:
-                response.raise_for_status()
-                page_content = await response.text()
-                # Accept any response that has reasonable content
-                if len(page_content) < 100:
-                    return []  # Too short, probably an error
-    except Exception:
-        return []  # Fail silently, will be retried
+    # Browse params depend only on the location, so a location seen before
+    # (or a resumed search) goes straight to GraphQL without loading the page
+    browse_params = state.get("browse_params") if state else None
+    browse_params = browse_params or client.cached_browse_params(location_id_from_url(url))
+    page_content = None
 
-    # Use cached doc_id instead of extracting again
-    doc_id = cached_doc_id
-    print(f"Using cached doc_id: {doc_id}")
+    if browse_params:
+        print("Using cached browse parameters, skipping page fetch")
+    else:
+        # Get marketplace page HTML
+        print("Fetching marketplace page...")
+        try:
+            page_content = await client.fetch_page(url, current_headers)
+            # Accept any response that has reasonable content
+            if len(page_content) < 100:
+                return  # Too short, probably an error
+        except Exception:
+            return  # Fail silently, will be retried
+
+        # Extract browse parameters from the page (location-specific)
+        print("Extracting browse parameters...")
+        browse_params = client.get_browse_params(url, page_content)
+
+    # Prefer an id rediscovered since cached_doc_id was read, e.g. by a concurrent search
+    cached_doc_id = client.doc_ids.get("search") or cached_doc_id
 
-    # Extract browse parameters from the page (location-specific)
-    print("Extracting browse parameters...")
-    browse_params = extract_browse_params(page_content)
+    # A resumed cursor is only valid with the doc_id and browse params it came from
+    if state and state.get("doc_id"):
+        cached_doc_id = state["doc_id"]
+
+    # Use cached doc_id instead of extracting again
+    print(f"Using cached doc_id: {cached_doc_id}")
 
     if not browse_params:
-        return []
+        return
+
+    if state is not None:
+        state["browse_params"] = browse_params
 
     print(f"Location: {browse_params['filter_location_latitude']}, {browse_params['filter_location_longitude']} (Radius: {browse_params['filter_radius_km']}km)")
 
-    # Initialize variables for pagination
-    all_listings = []
-    cursor = None
-    items_per_page = 24
-
-    timeout = aiohttp.ClientTimeout(total=8)  # Optimized timeout
-
-    async with aiohttp.ClientSession(timeout=timeout, cookies=cookies) as session:
-        while max_items is None or len(all_listings) < max_items:
-
-            # Prepare GraphQL variables
-            if cursor:
-                # Use cursor for pagination
-                variables = {
-                    "count": items_per_page,
-                    "cursor": cursor,
-                    "params": {
-                        "bqf": {"callsite": "COMMERCE_MKTPLACE_WWW", "query": search_query},
-                        "browse_request_params": browse_params,
-                        "custom_request_params": {
-                            "browse_context": None,
-                            "contextual_filters": [],
-                            "referral_code": None,
-                            "referral_ui_component": None,
-                            "saved_search_strid": None,
-                            "search_vertical": "C2C",
-                            "seo_url": None,
-                            "serp_landing_settings": {"virtual_category_id": ""},
-                            "surface": "SEARCH",
-                            "virtual_contextual_filters": []
-                        }
-                    },
-                    "scale": 1
-                }
-            else:
-                # First page - use the original cursor
-                variables = {
-                    "count": items_per_page,
-                    "cursor": "{\"pg\":1,\"b2c\":{\"br\":\"\",\"it\":0,\"hmsr\":false,\"tbi\":0},\"c2c\":{\"br\":\"AbrOVXU1wQAxZIwDA-LNo4zTOGyNjx6X9DVtPnVeCddFbXL-ibLXjBbVbJl8tONW4FuuQG_4tZ75a_TZzSFXeuYzvIyQShXoCQ3NjpMY66g32rVt4XIAi4cHMsW4PyjnHY74qnaPiIwY3NxSzGYD-0ob0-8GFJdYRK7tJd1d9m7W2WiLU-uTU5Jzk_5xRXbXdkzNbqmRvFIxfDCeVfsiEqdGN1h3Ihp6D8Hxjx3L2Aasxg_qTPYAJwJj8VuchU0YgwGN0oyIyCLrX-T6njFV7xeOG3QOwOILiv7xAaYgHUWhBm8S0TPoOdXwYTnYqwAxZrJzwS8cXrau9JSs2QJCHP7A3szCZGbM2wxbIbmubzB4wvitgrdXKWZFfMy03dOLGlaNWbZzat2ODzOFExvigvmNVUN9S2Pb3pA_HIuDs18YLWl-BdFhpRhB_uBMkqrOQ-yRHlm6D28h-aUEUviPu-s0dLQib3LSoVUFwbJIrinZpN2s7S-fRGHUktAkNatxlGb5vI2eHI2Sl9QlFtxetLZKmRF5Igmxh8eSY4oKJH5NWpNxeIsYdue9WmWmQdGJ_pp0tls2cL3AZ39t-9rGhdPu7EHtTBOkPrnPn_dqHjWNLucKQmzuy9lFJ__T6b85I_TymDQljNo5rVSKkLMaE_v3QGOpAXj1ojUGTRtJXkKmWQ\",\"it\":20,\"rpbr\":\"\",\"rphr\":false,\"rmhr\":false},\"ads\":{\"items_since_last_ad\":20,\"items_retrieved\":20,\"ad_index\":0,\"ad_slot\":0,\"dynamic_gap_rule\":0,\"counted_organic_items\":0,\"average_organic_score\":0,\"is_dynamic_gap_rule_set\":false,\"first_organic_score\":0,\"is_dynamic_initial_gap_set\":false,\"iterated_organic_items\":0,\"top_organic_score\":0,\"feed_slice_number\":0,\"feed_retrieved_items\":0,\"ad_req_id\":855487502,\"refresh_ts\":0,\"cursor_id\":28097,\"mc_id\":0,\"ad_index_e2e\":0,\"seen_ads\":{\"ad_ids\":[],\"page_ids\":[],\"campaign_ids\":[]},\"has_ad_index_been_reset\":false,\"is_reconsideration_ads_dropped\":false},\"irr\":false,\"serp_cta\":false,\"rui\":[],\"mpid\":[],\"ubp\":null,\"ncrnd\":1,\"irsr\":false,\"bmpr\":[],\"bmpeid\":[],\"nmbmp\":false,\"skrr\":false,\"ioour\":false,\"ise\":false,\"sms_cursor\":{\"page_index\":0,\"blended_ad_index\":0,\"organics_since_last_ad\":0,\"page_organic_count\":0,\"blended_organic_index\":0,\"returned_ad_index\":0,\"total_index\":0}}",
-                    "params": {
-                        "bqf": {"callsite": "COMMERCE_MKTPLACE_WWW", "query": search_query},
-                        "browse_request_params": browse_params,
-                        "custom_request_params": {
-                            "browse_context": None,
-                            "contextual_filters": [],
-                            "referral_code": None,
-                            "referral_ui_component": None,
-                            "saved_search_strid": None,
-                            "search_vertical": "C2C",
-                            "seo_url": None,
-                            "serp_landing_settings": {"virtual_category_id": ""},
-                            "surface": "SEARCH",
-                            "virtual_contextual_filters": []
-                        }
-                    },
-                    "scale": 1
-                }
-
-            # Prepare data with dynamic doc_id
-            data = {
-                'server_timestamps': 'true',
-                'variables': json.dumps(variables),
-                'doc_id': cached_doc_id,
-            }
-
-            # Make GraphQL request using aiohttp for better performance
-            try:
-                proxy_url = get_proxy_url(for_aiohttp=True)
-                async with session.post('https://www.facebook.com/api/graphql/',
-                                       headers=headers,
-                                       data=data,
-                                       proxy=proxy_url) as response:
+    if config.get("geoTiles") and not (state and state.get("cursor")):
+        # Spread one wide search over many concurrent cursor chains
+        pages = iter_tiled_pages(client, search_query, browse_params, cached_doc_id,
+                                 page_content, current_headers, headers, max_items, page_url=url)
+    else:
+        pages = iter_search_pages(client, search_query, browse_params, cached_doc_id,
+                                  page_content, current_headers, headers, max_items, state=state, page_url=url)
 
-                    if response.status != 200:
-                        break
+    async for page_listings in pages:
+        yield page_listings
 
-                    response_text = await response.text()
-                    response_data = json.loads(response_text)
+async def process_single_url(url, cached_doc_id, max_items=None, client=None):
+    """Process a single marketplace URL and return its listings."""
+    all_listings = []
+    async for page_listings in iter_listings(url, cached_doc_id, max_items, client=client):
+        all_listings.extend(page_listings)
+    return all_listings
 
-            except Exception:
-                break
+async def load_pdp_doc_id_from_listing(client, url, cached_doc_id, current_headers):
+    """
+    Fallback for when the search page bundles do not contain the PDP query:
+    visit a sample listing page and sweep its bundles instead.
+    """
+    sample_listings = await process_single_url(url, cached_doc_id, max_items=1, client=client)
+    if not sample_listings:
+        print("Warning: Could not get sample listings for PDP doc_id extraction")
+        return None
 
-            # Extract marketplace listings from this page
-            page_listings = extract_marketplace_listings(response_data, search_query=search_query, location="")
+    sample_listing_id = sample_listings[0].get("id")
+    if not sample_listing_id:
+        print("Warning: No listing ID found for PDP doc_id extraction")
+        return None
 
-            if not page_listings:
-                break
+    # Visit the listing page to extract PDP doc_id
+    listing_url = f"https://www.facebook.com/marketplace/item/{sample_listing_id}/"
+    print(f"Visiting listing page: {listing_url}")
 
-            # Add listings from this page to our collection
-            all_listings.extend(page_listings)
+    try:
+        listing_page_content = await client.fetch_page(listing_url, current_headers, browse_params=False)
+    except Exception as e:
+        print(f"Error visiting listing page for PDP doc_id: {e}")
+        return None
 
-            # Check if we have enough listings or if there's no next page
-            if max_items is not None and len(all_listings) >= max_items:
-                # Trim to max_items if we exceeded
-                all_listings = all_listings[:max_items]
-                break
+    doc_ids = await client.discover_doc_ids(listing_page_content, current_headers)
+    return doc_ids.get("pdp")
 
-            # Extract cursor for next page
-            try:
-                page_info = response_data.get("data", {}).get("marketplace_search", {}).get("feed_units", {}).get("page_info", {})
-                if not page_info.get("has_next_page", False):
-                    break
+def query_from_url(url, default='unknown'):
+    """The search query of a marketplace URL."""
+    query_params = parse_qs(urlparse(url).query)
+    return query_params.get('query', [default])[0]
 
-                cursor = page_info.get("end_cursor")
-                if not cursor:
-                    break
+def seen_scope(url):
+    """Seen-index scope of a search URL: its location and normalised query."""
+    return f"{location_id_from_url(url)}:{query_from_url(url).strip().lower()}"
 
-            except Exception:
-                break
+async def process_url_with_retry(url, cached_doc_id, writer, max_retries=3, max_items=None, client=None,
+                                 checkpoint=None, seen=None):
+    """Stream a single URL's listings to writer with retry logic. Returns (url, listings written)."""
+    search_query = query_from_url(url)
+    scope = seen_scope(url)
+    state = checkpoint.url_state(url) if checkpoint else None
+    emitted = state["emitted"] if state else set()
 
-            await asyncio.sleep(0.2)
+    if state and state["done"]:
+        print(f"Skipping {url}, already finished ({len(emitted)} listings)")
+        return url, 0
 
-    return all_listings
+    if state and state["cursor"]:
+        print(f"Resuming {url} after {len(emitted)} listings")
 
-async def process_url_with_retry(url, cached_doc_id, max_retries=3, max_items=None):
-    """Process a single URL with retry logic."""
     for attempt in range(max_retries):
         if attempt > 0:
             print(f"Retry {attempt}/{max_retries - 1} for {url}")
             await asyncio.sleep(2)  # Reduced delay
 
-        listings = await process_single_url(url, cached_doc_id, max_items)
-        if listings:
-            return url, listings
-
-    return url, []
-
-async def main():
-    """Main async function to scrape Facebook Marketplace with optional deep scraping."""
-
-    urls = config["urls"]
-    deep_scrape = config["deepScrape"]
-    count_value = config.get("count", 50)
-    # Handle empty string or None for unlimited scraping
-    if count_value == "" or count_value is None:
-        max_items = None  # None means unlimited
-    else:
-        max_items = int(count_value) if isinstance(count_value, str) else count_value
-
-    if not urls:
-        print("No URLs provided in config")
-        return
-
-    # Show configuration
-    print("Facebook Marketplace Scraper")
-    print(f"URLs: {len(urls)}")
-    print(f"Deep Scrape: {deep_scrape}")
-    print(f"Target Count: {max_items if max_items is not None else 'All'}")
-    print(f"Proxy: {'Enabled' if proxy['use_proxy'] else 'Disabled'}")
-    print("-" * 50)
+        remaining = None if max_items is None else max(0, max_items - len(emitted))
+        received = written = 0
+        async for page_listings in iter_listings(url, cached_doc_id, remaining, client=client, state=state):
+            received += len(page_listings)
+            new_listings = [listing for listing in page_listings if listing.get("id") not in emitted]
+
+            # Only listings no earlier run emitted are written
+            if seen:
+                page_ids = [listing["id"] for listing in page_listings if listing.get("id")]
+                unseen_ids = seen.unseen(scope, page_ids)
+                new_listings = [listing for listing in new_listings if listing.get("id") in unseen_ids]
+
+            writer.write_many(search_query, new_listings)
+            written += len(new_listings)
+            if writer.store is not None and len(new_listings) < len(page_listings):
+                # Listings skipped as already emitted are still on the market, refresh their last_seen
+                new_ids = {listing.get("id") for listing in new_listings}
+                writer.store.upsert_many([listing for listing in page_listings if listing.get("id") not in new_ids],
+                                         query=search_query)
+            if checkpoint:
+                checkpoint.page_done(url, [listing.get("id") for listing in new_listings if listing.get("id")])
+
+            if seen:
+                # Known IDs are re-added too, so listings still on the market never age out
+                seen.add(scope, page_ids)
+                if mostly_known(page_ids, unseen_ids):
+                    print(f"Stopping {url} early: page {len(page_ids) - len(unseen_ids)}/{len(page_ids)} already seen")
+                    if state is not None:
+                        state["done"] = True
+                    break
 
+        # Failed search pages are already retried in place, so the whole URL is
+        # only retried when nothing came through (e.g. the page fetch failed)
+        if received or (state and state["done"]):
+            break
+
+    if checkpoint:
+        checkpoint.save()
+    return url, written
+
+async def run_scrape(client, urls, deep_scrape, max_items, writer, checkpoint=None, seen=None, pdp_store=None):
+    """
+    Run a regular or deep scrape of urls through client, streaming listings to
+    writer as they arrive. Returns the number written per query (None on failure).
+    A checkpoint makes regular scrapes resumable; deep scrapes always start over.
+    A seen index limits either mode to listings no earlier run emitted, and a
+    PDP store lets deep scrapes skip the PDP query for unchanged listings.
+    """
     if deep_scrape:
         # Deep scraping mode
         print("Starting DEEP SCRAPING mode...")
 
-        # First, get listing IDs from search results
-        print("Phase 1: Collecting listing IDs from search results...")
+        print("Phase 1: Resolving search and PDP doc_ids...")
 
         # Extract doc_id once and cache it for all URLs
         print("Initializing scraper...")
         first_url = urls[0]
 
-        # Extract doc_id from the first URL
+        # Use the on-disk caches, only fetching the first URL on a miss; one
+        # fetch fills both doc_ids and its browse params, so its search below
+        # does not load the page again
         current_headers = headers.copy()
         current_headers['referer'] = first_url
 
         try:
-            timeout = aiohttp.ClientTimeout(total=8)
-            proxy_url = get_proxy_url(for_aiohttp=True)
-            connector = aiohttp.TCPConnector()
-
-            async with aiohttp.ClientSession(timeout=timeout, cookies=cookies, connector=connector) as session:
-                async with session.get(first_url, headers=current_headers, proxy=proxy_url) as response:
-                    response.raise_for_status()
-                    page_content = await response.text()
+            await client.warm_up(first_url, current_headers, doc_types=("search", "pdp"))
         except Exception as e:
             print(f"❌ Error fetching marketplace page for doc_id: {e}")
-            return
-
-        cached_doc_id = await extract_marketplace_doc_id(page_content, current_headers)
+        doc_ids = {doc_type: client.cached_doc_id(doc_type) for doc_type in ("search", "pdp")}
+        cached_doc_id = doc_ids.get("search")
 
         if not cached_doc_id:
             print("❌ Failed to extract doc_id")
-            return
+            return None
 
         print(f"Cached search doc_id: {cached_doc_id}")
 
-        # For deep scraping, we need the PDP doc_id from a listing page
-        print("Extracting PDP doc_id from a listing page...")
+        # The PDP doc_id normally comes from the same bundle sweep as the search one
+        cached_pdp_doc_id = doc_ids.get("pdp")
+        if not cached_pdp_doc_id:
+            print("PDP doc_id not in search page bundles, extracting it from a listing page...")
+            cached_pdp_doc_id = await load_pdp_doc_id_from_listing(client, urls[0], cached_doc_id, current_headers)
 
-        # First get a sample listing ID to visit its page
-        sample_listings = await process_single_url(urls[0], cached_doc_id, max_items=1)
-        if not sample_listings:
-            print("Warning: Could not get sample listings for PDP doc_id extraction")
-            cached_pdp_doc_id = "33071634612482224"  # Fallback to known working doc_id
+        if cached_pdp_doc_id:
+            print(f"Cached PDP doc_id: {cached_pdp_doc_id}")
         else:
-            sample_listing_id = sample_listings[0].get("id")
-            if sample_listing_id:
-                # Visit the listing page to extract PDP doc_id
-                listing_url = f"https://www.facebook.com/marketplace/item/{sample_listing_id}/"
-                print(f"Visiting listing page: {listing_url}")
-
-                try:
-                    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=8), cookies=cookies) as listing_session:
-                        async with listing_session.get(listing_url, headers=current_headers) as listing_response:
-                            listing_response.raise_for_status()
-                            listing_page_content = await listing_response.text()
-
-                            cached_pdp_doc_id = await extract_marketplace_pdp_doc_id(listing_page_content, current_headers)
-                            if cached_pdp_doc_id:
-                                print(f"Successfully extracted PDP doc_id: {cached_pdp_doc_id}")
-                            else:
-                                print("Warning: Could not extract PDP doc_id from listing page, using fallback")
-                                cached_pdp_doc_id = "33071634612482224"  # Fallback to known working doc_id
-                except Exception as e:
-                    print(f"Error visiting listing page for PDP doc_id: {e}")
-                    cached_pdp_doc_id = "33071634612482224"  # Fallback to known working doc_id
-            else:
-                print("Warning: No listing ID found for PDP doc_id extraction")
-                cached_pdp_doc_id = "33071634612482224"  # Fallback to known working doc_id
-
-        # Collect listing IDs from search results
-        listing_ids = set()
-        for url in urls:
-            print(f"Processing search URL: {url}")
-            listings = await process_single_url(url, cached_doc_id, max_items)
-
-            for listing in listings:
-                if listing.get("id"):
-                    listing_ids.add(listing["id"])
-
-            print(f"Found {len(listings)} listings in this search")
-
-        print(f"Total unique listing IDs collected: {len(listing_ids)}")
+            print("Warning: Could not extract PDP doc_id, using fallback")
+            cached_pdp_doc_id = "33071634612482224"  # Fallback to known working doc_id
 
-        # Phase 2: Get detailed data for each listing
-        print("Phase 2: Fetching detailed data for each listing...")
+        # Paginate every search URL at once and fetch each listing's PDP as soon
+        # as its ID arrives, instead of waiting for all search pages first
+        print(f"Phase 2: Fetching detailed data while {len(urls)} searches paginate...")
 
-        # Create optimized session for concurrent PDP requests
-        timeout = aiohttp.ClientTimeout(total=12)
-        proxy_url = get_proxy_url(for_aiohttp=True)
-        connector = aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=30)
-        shared_session = aiohttp.ClientSession(timeout=timeout, cookies=cookies, connector=connector)
+        listing_ids = set()
+        listing_queue = asyncio.Queue()
+
+        # Seen-index scope and search fingerprint of each queued listing, used once its PDP is written
+        listing_scopes = {}
+        listing_fingerprints = {}
+        detailed = served_from_store = 0
+
+        def serve_stored(listing, scope):
+            """Write a listing's stored PDP details if it is unchanged since they were fetched."""
+            nonlocal detailed, served_from_store
+            if not pdp_store:
+                return False
+            fingerprint = listing_fingerprint(listing)
+            listing_fingerprints[listing["id"]] = fingerprint
+            stored = pdp_store.get(listing["id"], fingerprint)
+            if not stored:
+                return False
+            writer.write_many("deep_scraped", stored, source="pdp")
+            detailed += len(stored)
+            served_from_store += 1
+            if seen:
+                seen.add(scope, [listing["id"]])
+            return True
+
+        async def search(url):
+            print(f"Processing search URL: {url}")
+            found = 0
+            scope = seen_scope(url)
+            async for page_listings in iter_listings(url, cached_doc_id, max_items, client=client):
+                found += len(page_listings)
+                if writer.store is not None:
+                    # Keep the search-level fields next to the PDP details in the database
+                    writer.store.upsert_many(page_listings, query=query_from_url(url))
+                page_ids = [listing["id"] for listing in page_listings if listing.get("id")]
+                unseen_ids = seen.unseen(scope, page_ids) if seen else set(page_ids)
+
+                for listing in page_listings:
+                    listing_id = listing.get("id")
+                    if listing_id not in unseen_ids or listing_id in listing_ids:
+                        continue
+                    if max_items is not None and len(listing_ids) >= max_items:
+                        break
+                    listing_ids.add(listing_id)
+                    listing_scopes[listing_id] = scope
+                    if not serve_stored(listing, scope):
+                        listing_queue.put_nowait(listing_id)
 
-        detailed_listings = []
-        target_listing_ids = list(listing_ids)[:max_items] if max_items else list(listing_ids)
+                if seen and mostly_known(page_ids, unseen_ids):
+                    print(f"Stopping {url} early: page {len(page_ids) - len(unseen_ids)}/{len(page_ids)} already seen")
+                    break
+            print(f"Found {found} listings in this search")
 
+        async def search_all():
+            try:
+                results = await asyncio.gather(*(search(url) for url in urls), return_exceptions=True)
+                for result in results:
+                    if isinstance(result, Exception):
+                        print(f"❌ Error in search pagination: {result}")
+            finally:
+                # Tell the PDP workers no more IDs are coming
+                listing_queue.put_nowait(None)
+
+        async def queued_listing_ids():
+            while True:
+                listing_id = await listing_queue.get()
+                if listing_id is None:
+                    return
+                yield listing_id
+
+        # Fetch PDPs with an adaptive concurrency limit, handling each result as it arrives
+        limiter = AdaptiveLimiter()
+
+        async def fetch_details(listing_id):
+            # Pick up a PDP doc_id rediscovered mid-run by another fetch
+            pdp_doc_id = client.doc_ids.get("pdp") or cached_pdp_doc_id
+            return await get_detailed_listing_data(client, listing_id, pdp_doc_id, refresh_url=first_url)
+
+        searches = asyncio.create_task(search_all())
         try:
-            # Create concurrent tasks for all PDP requests
-            tasks = []
-            for listing_id in target_listing_ids:
-                task = get_detailed_listing_data(shared_session, listing_id, cached_pdp_doc_id, proxy_url)
-                tasks.append(task)
-
-            print(f"Processing {len(tasks)} listings concurrently...")
-
-            # Execute all requests concurrently
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-
-            # Process results
-            for i, result in enumerate(results):
-                listing_id = target_listing_ids[i]
+            async for listing_id, result in map_adaptive(queued_listing_ids(), fetch_details, limiter):
                 if isinstance(result, Exception):
                     print(f"Warning: Failed to get detailed data for listing {listing_id}: {result}")
                     continue
@@ -446,21 +474,23 @@ async def main():
                     # Optimized extraction logic
                     extracted_listings = extract_listing_from_pdp_response(result)
                     if extracted_listings:
-                        detailed_listings.extend(extracted_listings)
+                        # Deep scraped listings are grouped under one key
+                        writer.write_many("deep_scraped", extracted_listings, source="pdp")
+                        detailed += len(extracted_listings)
+                        if pdp_store:
+                            pdp_store.set(listing_id, listing_fingerprints[listing_id], extracted_listings)
+                        if seen:
+                            seen.add(listing_scopes[listing_id], [listing_id])
                     else:
                         print(f"Warning: No listings extracted from PDP response for {listing_id}")
-
         finally:
-            await shared_session.close()
+            searches.cancel()
+            await asyncio.gather(searches, return_exceptions=True)
+
+        print(f"Total unique listing IDs collected: {len(listing_ids)}")
+        print(f"PDP concurrency settled at {limiter.limit}")
 
-        # Group by query for consistency with regular mode
-        all_results = {}
-        for listing in detailed_listings:
-            # Try to determine query from the listing data or use default
-            query = "deep_scraped"  # Default category for deep scraped listings
-            if query not in all_results:
-                all_results[query] = []
-            all_results[query].append(listing)
+        print(f"Detailed listings written: {detailed} ({served_from_store} unchanged listings served from the PDP store)")
 
     else:
         # Regular scraping mode (existing logic)
@@ -470,77 +500,123 @@ async def main():
         print("Initializing scraper...")
         first_url = urls[0]
 
-        # Extract doc_id from the first URL
+        # Use the on-disk caches, only fetching the first URL on a miss; one
+        # fetch fills both its doc_ids and its browse params, so its search
+        # below does not load the page again
         current_headers = headers.copy()
         current_headers['referer'] = first_url
 
         try:
-            timeout = aiohttp.ClientTimeout(total=8)
-            proxy_url = get_proxy_url(for_aiohttp=True)
-            connector = aiohttp.TCPConnector()
-
-            async with aiohttp.ClientSession(timeout=timeout, cookies=cookies, connector=connector) as session:
-                async with session.get(first_url, headers=current_headers, proxy=proxy_url) as response:
-                    response.raise_for_status()
-                    page_content = await response.text()
+            await client.warm_up(first_url, current_headers)
         except Exception as e:
             print(f"❌ Error fetching marketplace page for doc_id: {e}")
-            return
-
-        cached_doc_id = await extract_marketplace_doc_id(page_content, current_headers)
+        cached_doc_id = client.cached_doc_id("search")
 
         if not cached_doc_id:
             print("❌ Failed to extract doc_id")
-            return
+            return None
 
         print(f"Cached doc_id: {cached_doc_id}")
         print(f"Processing {len(urls)} URLs concurrently...")
 
-        # Process all URLs concurrently
-        tasks = [process_url_with_retry(url, cached_doc_id, max_retries=3, max_items=max_items) for url in urls]
+        # Process all URLs concurrently, each writing its pages as they arrive
+        tasks = [process_url_with_retry(url, cached_doc_id, writer, max_retries=3, max_items=max_items, client=client,
+                                        checkpoint=checkpoint, seen=seen) for url in urls]
         results = await asyncio.gather(*tasks, return_exceptions=True)
 
-        # Process results and group by query
-        all_results = {}
-        total_listings = 0
-
         for result in results:
             if isinstance(result, Exception):
                 print(f"❌ Error in concurrent processing: {result}")
                 continue
 
-            url, listings = result
-            total_listings += len(listings)
+            url, written = result
+
+            # Minimal progress indicator
+            print(f"{query_from_url(url)}: {written} listings")
+
+    return writer.counts
+
+def load_checkpoint(urls, output_path, writer):
+    """
+    Load config["checkpoint"] for a resumed run. Listings that reached the
+    output after the last save are counted as emitted too, so a crash between
+    a write and the next checkpoint cannot produce duplicates.
+    """
+    checkpoint = Checkpoint.load(config.get("checkpoint") or "checkpoint.json", writer=writer)
+    urls_by_query = {}
+    for url in urls:
+        urls_by_query.setdefault(query_from_url(url), []).append(checkpoint.url_state(url))
+
+    if os.path.exists(output_path):
+        for query, listing in iter_ndjson(output_path):
+            for state in urls_by_query.get(query, []):
+                if listing.get("id"):
+                    state["emitted"].add(listing["id"])
+
+    return checkpoint
 
-            # Extract query from URL for grouping
-            parsed = urlparse(url)
-            query_params = parse_qs(parsed.query)
-            search_query = query_params.get('query', ['unknown'])[0]
+async def main():
+    """Main async function to scrape Facebook Marketplace with optional deep scraping."""
 
-            # Group by query
-            if search_query not in all_results:
-                all_results[search_query] = []
+    urls = config["urls"]
+    deep_scrape = config["deepScrape"]
+    count_value = config.get("count", 50)
+    # Handle empty string or None for unlimited scraping
+    if count_value == "" or count_value is None:
+        max_items = None  # None means unlimited
+    else:
+        max_items = int(count_value) if isinstance(count_value, str) else count_value
 
-            all_results[search_query].extend(listings)
+    if not urls:
+        print("No URLs provided in config")
+        return
 
-            # Minimal progress indicator
-            print(f"{search_query}: {len(listings)} listings")
+    # Show configuration
+    print("Facebook Marketplace Scraper")
+    print(f"URLs: {len(urls)}")
+    print(f"Deep Scrape: {deep_scrape}")
+    print(f"Target Count: {max_items if max_items is not None else 'All'}")
+    print(f"Proxy: {'Enabled' if proxy['use_proxy'] else 'Disabled'}")
+    print("-" * 50)
+
+    # One pooled client for every request made by this run, and listings go
+    # straight to disk instead of piling up in memory
+    output_path = config.get("output") or "output.ndjson"
+    resume = bool(config.get("resume")) and not deep_scrape
+    store = ListingStore() if config.get("database") else None
+    with NDJSONWriter(output_path, append=resume, store=store) as writer:
+        checkpoint = load_checkpoint(urls, output_path, writer) if resume else None
+        if checkpoint is None and config.get("checkpoint") and not deep_scrape:
+            checkpoint = Checkpoint(config["checkpoint"], writer=writer)
+
+        pdp_store = PDPStore(max_age=config["pdpMaxAge"]) if deep_scrape and config.get("pdpMaxAge") else None
+
+        seen = None
+        if config.get("newOnly"):
+            seen = SeenIndex()
+            seen.prune()
+
+        async with MarketplaceClient(cookies=cookies, proxy_url=get_proxy_url(for_aiohttp=True)) as client:
+            counts = await run_scrape(client, urls, deep_scrape, max_items, writer, checkpoint, seen, pdp_store)
+
+    if counts is None:
+        return
 
     # Output results
-    total_listings = sum(len(listings) for listings in all_results.values())
+    total_listings = sum(counts.values())
     print(f"\nScraping Complete!")
     print(f"Total: {total_listings} listings from {len(urls)} URLs")
     print(f"Mode: {'Deep Scraping' if deep_scrape else 'Regular Scraping'}")
+    print(f"Results saved to {output_path}")
 
-    # Save results
-    with open("output.json", "w", encoding="utf-8") as f:
-        json.dump(all_results, f, indent=2, ensure_ascii=False)
-
-    print("Results saved to output.json")
+    # Optionally rebuild the grouped-by-query JSON older tooling expects
+    if config.get("groupedOutput"):
+        rebuild_grouped_json(output_path, config["groupedOutput"])
+        print(f"Grouped results saved to {config['groupedOutput']}")
 
     # Summary by query
-    for query, listings in all_results.items():
-        print(f"{query}: {len(listings)} listings")
+    for query, count in counts.items():
+        print(f"{query}: {count} listings")
 
 if __name__ == "__main__":
     asyncio.run(main())
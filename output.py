@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import time
+
+# Flush buffered listings to disk after this many writes or seconds, whichever comes first
+FLUSH_EVERY = 100
+FLUSH_INTERVAL = 2.0
+
+# When to fsync: "never" leaves it to the OS, "flush" syncs on every periodic
+# flush, "always" syncs after every listing
+FSYNC_POLICIES = ("never", "flush", "always")
+
+
+class NDJSONWriter:
+    """
+    Streaming output sink: one compact JSON object per line, written as
+    listings arrive.
+
+    Each line is {"query": ..., "listing": ...}. Nothing is kept in memory
+    beyond the file buffer and a per-query count, and whatever was flushed
+    survives a crash; rebuild_grouped_json turns the file back into the old
+    grouped-by-query output.json layout.
+
+    With a store (storage.ListingStore) every batch is also upserted into the
+    listings database.
+    """
+
+    def __init__(self, path, flush_every=FLUSH_EVERY, flush_interval=FLUSH_INTERVAL, fsync="flush", append=False,
+                 store=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}, got {fsync!r}")
+        self.path = path
+        self.store = store
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.counts = {}  # query -> listings written
+        self._file = open(path, "a" if append else "w", encoding="utf-8")
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def write(self, query, listing):
+        """Append one listing tagged with its query."""
+        self._file.write(json.dumps({"query": query, "listing": listing}, ensure_ascii=False, separators=(",", ":")))
+        self._file.write("\n")
+        self.counts[query] = self.counts.get(query, 0) + 1
+        self._unflushed += 1
+
+        if self.fsync == "always":
+            self.flush()
+        elif self._unflushed >= self.flush_every or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def write_many(self, query, listings, source="search"):
+        """Append a batch of listings; source says whether they are search results or PDP details."""
+        for listing in listings:
+            self.write(query, listing)
+        if self.store is not None and listings:
+            self.store.upsert_many(listings, query=query, source=source)
+
+    def flush(self):
+        self._file.flush()
+        if self.fsync != "never":
+            os.fsync(self._file.fileno())
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def iter_ndjson(path):
+    """Yield (query, listing) pairs from an NDJSON output file, skipping a line cut off by a crash."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            yield record["query"], record["listing"]
+
+
+def rebuild_grouped_json(ndjson_path, json_path):
+    """Write the listings of ndjson_path to json_path grouped by query, like the old output.json."""
+    all_results = {}
+    for query, listing in iter_ndjson(ndjson_path):
+        all_results.setdefault(query, []).append(listing)
+
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(all_results, f, indent=2, ensure_ascii=False)
+
+    return all_results
+
+
+if __name__ == "__main__":
+    # python output.py output.ndjson output.json
+    if len(sys.argv) != 3:
+        print("Usage: python output.py <input.ndjson> <output.json>")
+        sys.exit(1)
+    grouped = rebuild_grouped_json(sys.argv[1], sys.argv[2])
+    for query, listings in grouped.items():
+        print(f"{query}: {len(listings)} listings")
@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from cache import thread_connection
+
+# Detailed PDP results from earlier deep scrapes, keyed by listing ID
+PDP_STORE_PATH = os.environ.get(
+    "FB_MARKETPLACE_PDP_STORE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "pdp.db")
+)
+
+# Stored details are refetched after this long even if the listing looks unchanged
+PDP_MAX_AGE = 24 * 60 * 60
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS pdp ("
+    " listing_id TEXT PRIMARY KEY,"
+    " fingerprint TEXT NOT NULL,"
+    " details TEXT NOT NULL,"
+    " fetched_at REAL NOT NULL)",
+)
+
+
+def listing_fingerprint(listing):
+    """
+    Hash of the search-result fields that change when a listing does: price,
+    sold/pending state, title and primary photo. Two search results with the
+    same fingerprint are served the same PDP details.
+    """
+    photo = listing.get("primary_listing_photo") or {}
+    fields = [
+        listing.get("listing_price"),
+        listing.get("is_sold"),
+        listing.get("is_pending"),
+        listing.get("marketplace_listing_title"),
+        photo.get("id"),
+    ]
+    return hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class PDPStore:
+    """
+    Local store of extracted PDP details per listing ID, with the fingerprint
+    of the search result they were fetched for.
+
+    Deep scrapes look a listing up here before calling the PDP query and only
+    fetch it when it is new, its fingerprint changed or the stored copy is
+    older than max_age. Safe across processes; errors only cost a refetch.
+    """
+
+    def __init__(self, path=PDP_STORE_PATH, max_age=PDP_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self._local = threading.local()
+
+    def _connect(self):
+        return thread_connection(self._local, self.path, SCHEMA)
+
+    def get(self, listing_id, fingerprint):
+        """Stored details for listing_id if they match fingerprint and are fresh enough, else None."""
+        try:
+            row = self._connect().execute(
+                "SELECT fingerprint, details, fetched_at FROM pdp WHERE listing_id = ?",
+                (listing_id,)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+
+        if row is None:
+            return None
+        stored_fingerprint, details, fetched_at = row
+        if stored_fingerprint != fingerprint:
+            return None
+        if self.max_age and time.time() - fetched_at > self.max_age:
+            return None
+        return json.loads(details)
+
+    def set(self, listing_id, fingerprint, details):
+        """Store the details fetched for listing_id's current fingerprint."""
+        try:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO pdp (listing_id, fingerprint, details, fetched_at) VALUES (?, ?, ?, ?)",
+                (listing_id, fingerprint, json.dumps(details, ensure_ascii=False), time.time())
+            )
+        except sqlite3.Error:
+            pass
@@ -0,0 +1,132 @@
+import asyncio
+import time
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit driven by observed latency and errors.
+
+    Every `limit` successful requests in a row raise the limit by one; an
+    error or a response slower than latency_target halves it (at most once
+    per cooldown, so one burst of failures only counts once). maximum is a
+    hard ceiling, which also bounds how many responses are held in memory.
+    """
+
+    def __init__(self, initial=8, minimum=1, maximum=64, latency_target=4.0, cooldown=1.0):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self._successes = 0
+        self._last_decrease = 0.0
+
+    def record(self, success, latency):
+        """Feed back the outcome of one request."""
+        if success and latency <= self.latency_target:
+            self._successes += 1
+            if self._successes >= self.limit:
+                self.limit = min(self.maximum, self.limit + 1)
+                self._successes = 0
+            return
+
+        self._successes = 0
+        now = time.monotonic()
+        if now - self._last_decrease >= self.cooldown:
+            self.limit = max(self.minimum, self.limit // 2)
+            self._last_decrease = now
+
+
+class TokenBucket:
+    """
+    Request budget for one class of endpoint: up to burst requests at once,
+    refilled at rate per second. acquire() returns immediately while tokens
+    are available and otherwise waits just long enough for the next one, so
+    idle capacity is used at once and sustained load stays at rate. Waiters
+    are served in arrival order. A rate of None or 0 means unlimited.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        async with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+async def _iterate(items):
+    for item in items:
+        yield item
+
+
+async def map_adaptive(items, fetch, limiter=None):
+    """
+    Run fetch(item) for every item with at most limiter.limit calls in flight
+    and yield (item, result) pairs as they complete. items may be a regular or
+    an async iterable, so work can start while items are still being produced.
+    A raised exception is yielded as the result, like
+    asyncio.gather(return_exceptions=True); a result of None counts as a
+    failure for the limiter.
+
+    New calls are only started while the caller keeps consuming, so a slow
+    consumer applies backpressure instead of letting finished responses pile up.
+    """
+    limiter = limiter or AdaptiveLimiter()
+    source = items.__aiter__() if hasattr(items, "__aiter__") else _iterate(items).__aiter__()
+    pending = set()
+    next_item = None
+    exhausted = False
+
+    async def timed(item):
+        started = time.monotonic()
+        try:
+            result = await fetch(item)
+        except Exception as e:
+            result = e
+        success = result is not None and not isinstance(result, Exception)
+        limiter.record(success, time.monotonic() - started)
+        return item, result
+
+    try:
+        while True:
+            # Only ask for another item while there is room for it
+            if next_item is None and not exhausted and len(pending) < limiter.limit:
+                next_item = asyncio.ensure_future(source.__anext__())
+
+            waiting = pending | {next_item} if next_item else pending
+            if not waiting:
+                return
+
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+
+            if next_item in done:
+                try:
+                    pending.add(asyncio.create_task(timed(next_item.result())))
+                except StopAsyncIteration:
+                    exhausted = True
+                next_item = None
+
+            for task in done & pending:
+                pending.discard(task)
+                yield task.result()
+    finally:
+        if next_item is not None:
+            pending.add(next_item)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,223 @@
+import json
+import random
+import asyncio
+import aiohttp
+from extractor import extract_marketplace_listings
+from helper import is_stale_doc_id_response
+
+# Cursor the marketplace web client sends for the first page of a search
+FIRST_PAGE_CURSOR = "{\"pg\":1,\"b2c\":{\"br\":\"\",\"it\":0,\"hmsr\":false,\"tbi\":0},\"c2c\":{\"br\":\"AbrOVXU1wQAxZIwDA-LNo4zTOGyNjx6X9DVtPnVeCddFbXL-ibLXjBbVbJl8tONW4FuuQG_4tZ75a_TZzSFXeuYzvIyQShXoCQ3NjpMY66g32rVt4XIAi4cHMsW4PyjnHY74qnaPiIwY3NxSzGYD-0ob0-8GFJdYRK7tJd1d9m7W2WiLU-uTU5Jzk_5xRXbXdkzNbqmRvFIxfDCeVfsiEqdGN1h3Ihp6D8Hxjx3L2Aasxg_qTPYAJwJj8VuchU0YgwGN0oyIyCLrX-T6njFV7xeOG3QOwOILiv7xAaYgHUWhBm8S0TPoOdXwYTnYqwAxZrJzwS8cXrau9JSs2QJCHP7A3szCZGbM2wxbIbmubzB4wvitgrdXKWZFfMy03dOLGlaNWbZzat2ODzOFExvigvmNVUN9S2Pb3pA_HIuDs18YLWl-BdFhpRhB_uBMkqrOQ-yRHlm6D28h-aUEUviPu-s0dLQib3LSoVUFwbJIrinZpN2s7S-fRGHUktAkNatxlGb5vI2eHI2Sl9QlFtxetLZKmRF5Igmxh8eSY4oKJH5NWpNxeIsYdue9WmWmQdGJ_pp0tls2cL3AZ39t-9rGhdPu7EHtTBOkPrnPn_dqHjWNLucKQmzuy9lFJ__T6b85I_TymDQljNo5rVSKkLMaE_v3QGOpAXj1ojUGTRtJXkKmWQ\",\"it\":20,\"rpbr\":\"\",\"rphr\":false,\"rmhr\":false},\"ads\":{\"items_since_last_ad\":20,\"items_retrieved\":20,\"ad_index\":0,\"ad_slot\":0,\"dynamic_gap_rule\":0,\"counted_organic_items\":0,\"average_organic_score\":0,\"is_dynamic_gap_rule_set\":false,\"first_organic_score\":0,\"is_dynamic_initial_gap_set\":false,\"iterated_organic_items\":0,\"top_organic_score\":0,\"feed_slice_number\":0,\"feed_retrieved_items\":0,\"ad_req_id\":855487502,\"refresh_ts\":0,\"cursor_id\":28097,\"mc_id\":0,\"ad_index_e2e\":0,\"seen_ads\":{\"ad_ids\":[],\"page_ids\":[],\"campaign_ids\":[]},\"has_ad_index_been_reset\":false,\"is_reconsideration_ads_dropped\":false},\"irr\":false,\"serp_cta\":false,\"rui\":[],\"mpid\":[],\"ubp\":null,\"ncrnd\":1,\"irsr\":false,\"bmpr\":[],\"bmpeid\":[],\"nmbmp\":false,\"skrr\":false,\"ioour\":false,\"ise\":false,\"sms_cursor\":{\"page_index\":0,\"blended_ad_index\":0,\"organics_since_last_ad\":0,\"page_organic_count\":0,\"blended_organic_index\":0,\"returned_ad_index\":0,\"total_index\":0}}"
+
+# Listings requested per GraphQL page by the marketplace web client, always honoured
+ITEMS_PER_PAGE = 24
+
+# Page size tried until the search endpoint's real limit has been learnt; a
+# capped response (fewer edges but another page) seen twice with the same
+# count records the limit in the client
+MAX_PAGE_SIZE = 100
+
+# A failed search page is retried this many times, keeping its cursor
+PAGE_RETRIES = 4
+
+# Exponential backoff between page retries (seconds), with full jitter
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+
+# HTTP statuses worth retrying: timeouts, rate limiting and server errors
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+def search_variables(query, browse_params, cursor=None, count=ITEMS_PER_PAGE):
+    """GraphQL variables for one page of a marketplace search."""
+    return {
+        "count": count,
+        "cursor": cursor or FIRST_PAGE_CURSOR,
+        "params": {
+            "bqf": {"callsite": "COMMERCE_MKTPLACE_WWW", "query": query},
+            "browse_request_params": browse_params,
+            "custom_request_params": {
+                "browse_context": None,
+                "contextual_filters": [],
+                "referral_code": None,
+                "referral_ui_component": None,
+                "saved_search_strid": None,
+                "search_vertical": "C2C",
+                "seo_url": None,
+                "serp_landing_settings": {"virtual_category_id": ""},
+                "surface": "SEARCH",
+                "virtual_contextual_filters": []
+            }
+        },
+        "scale": 1
+    }
+
+
+def page_edge_count(response_data):
+    """Number of edges in a search response, before any are filtered out as non-listings."""
+    try:
+        return len(response_data["data"]["marketplace_search"]["feed_units"]["edges"])
+    except (KeyError, TypeError):
+        return 0
+
+
+def is_error_response(response_data):
+    """True for a GraphQL response carrying errors and no data."""
+    return isinstance(response_data, dict) and bool(response_data.get("errors")) and not response_data.get("data")
+
+
+def next_page_cursor(response_data):
+    """end_cursor of a search response, or None on the last page."""
+    try:
+        page_info = response_data.get("data", {}).get("marketplace_search", {}).get("feed_units", {}).get("page_info", {})
+        if not page_info.get("has_next_page", False):
+            return None
+        return page_info.get("end_cursor")
+    except Exception:
+        return None
+
+
+def is_retryable_error(error):
+    """
+    True for transient failures (timeouts, dropped connections, rate limiting,
+    5xx, a truncated JSON body). Anything else, e.g. a 4xx from an expired
+    session, fails the same way on every attempt and is fatal.
+    """
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRYABLE_STATUSES
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError,
+                              aiohttp.ClientPayloadError, json.JSONDecodeError))
+
+
+def describe_error(error):
+    """Short one-line description of a request error for logs."""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return f"HTTP {error.status}"
+    return f"{type(error).__name__}: {error}" if str(error) else type(error).__name__
+
+
+def retry_delay(attempt):
+    """Backoff before retry number attempt (0-based): random in [0, base * 2**attempt], capped."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+async def fetch_search_page(client, data, graphql_headers, retries=PAGE_RETRIES):
+    """POST one search page, retrying retryable errors with backoff. Raises the last error."""
+    attempt = 0
+    while True:
+        try:
+            return await client.graphql(data, graphql_headers)
+        except Exception as e:
+            if attempt >= retries or not is_retryable_error(e):
+                raise
+            delay = retry_delay(attempt)
+            attempt += 1
+            print(f"Search page failed ({describe_error(e)}), retry {attempt}/{retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def iter_search_pages(client, query, browse_params, doc_id, page_content, page_headers,
+                            graphql_headers, max_items=None, state=None, page_url=None):
+    """
+    Paginate a marketplace search through client, yielding each page's
+    listings as soon as it is parsed, until max_items listings (None for no
+    limit), the last page, or a fatal error. page_content, page_headers and
+    page_url are only used to rediscover a rotated doc_id. state is an
+    optional resume dict (see checkpoint.Checkpoint), updated before each
+    page is yielded.
+    """
+    total = 0
+    cursor = state.get("cursor") if state else None
+    refreshed_from = set()  # doc_ids this search already replaced once
+    # The size client has learnt for the search operation, MAX_PAGE_SIZE until then
+    page_size = client.page_size("search", MAX_PAGE_SIZE)
+    rejected_size = None  # larger page size that just failed, until a smaller page shows whether it was the size
+    capped_at = None  # edge count of the last short page that still had a next page
+
+    while max_items is None or total < max_items:
+        count = page_size if max_items is None else min(page_size, max_items - total)
+        data = {
+            'server_timestamps': 'true',
+            'variables': json.dumps(search_variables(query, browse_params, cursor, count)),
+            'doc_id': doc_id,
+        }
+
+        try:
+            response_data = await fetch_search_page(client, data, graphql_headers)
+        except Exception as e:
+            # Transient failures were already retried from the same cursor, so
+            # pages already yielded are never requested again
+            if count > ITEMS_PER_PAGE and rejected_size is None and not is_retryable_error(e):
+                # Maybe the size was refused; only recorded if the default size then works
+                print(f"Page size {count} failed ({describe_error(e)}), retrying at {ITEMS_PER_PAGE}")
+                rejected_size, page_size = count, ITEMS_PER_PAGE
+                continue
+            print(f"Giving up on '{query}' after {total} listings: {describe_error(e)}")
+            return
+
+        # A rotated doc_id shows up as an error or as empty feed_units after a
+        # page that promised more; an empty first page is taken at face value,
+        # since most of them are just queries without results
+        stale = is_stale_doc_id_response(response_data)
+        if not stale and not is_error_response(response_data) and page_edge_count(response_data) == 0:
+            stale = cursor is not None
+
+        if stale:
+            # One re-discovery shared with every other search on the client, then
+            # the same page is retried with the new id; without page_content it
+            # fetches page_url
+            if doc_id in refreshed_from:
+                if state is not None and not is_stale_doc_id_response(response_data):
+                    state["done"] = True
+                return
+            refreshed_from.add(doc_id)
+            new_doc_id = await client.refresh_doc_id(page_content, page_headers, doc_id, url=page_url)
+            if not new_doc_id:
+                return
+            if new_doc_id == doc_id and not is_stale_doc_id_response(response_data):
+                # Re-discovery confirmed the id, so the page really was empty
+                if state is not None:
+                    state["done"] = True
+                return
+            doc_id = new_doc_id
+            continue
+
+        if is_error_response(response_data):
+            if count > ITEMS_PER_PAGE and rejected_size is None:
+                print(f"Page size {count} returned a GraphQL error, retrying at {ITEMS_PER_PAGE}")
+                rejected_size, page_size = count, ITEMS_PER_PAGE
+                continue
+        elif rejected_size is not None:
+            # The same page worked at the default size, so the larger one really is refused
+            print(f"Page size {rejected_size} is refused, using {ITEMS_PER_PAGE}")
+            client.set_page_size("search", ITEMS_PER_PAGE)
+            rejected_size = None
+
+        page_listings = extract_marketplace_listings(response_data, search_query=query, location="")
+        if not page_listings:
+            if state is not None:
+                state["done"] = True
+            return
+
+        # Trim to max_items if this page would exceed it
+        if max_items is not None:
+            page_listings = page_listings[:max_items - total]
+        total += len(page_listings)
+
+        cursor = next_page_cursor(response_data)
+        edges = page_edge_count(response_data)
+        if cursor and count == page_size and 0 < edges < count:
+            # A short page with more to come may be a cap, or just a feed gap:
+            # only the same count twice is taken as the largest size honoured
+            if edges == capped_at:
+                page_size = max(ITEMS_PER_PAGE, edges)
+                client.set_page_size("search", page_size)
+                print(f"Search pages are capped at {edges} listings, using page size {page_size}")
+            capped_at = edges
+        elif edges == count:
+            capped_at = None
+        if state is not None:
+            state.update(cursor=cursor, doc_id=doc_id, done=not cursor)
+        yield page_listings
+
+        if not cursor:
+            return
@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import threading
+import time
+from cache import thread_connection
+
+# Listing IDs already emitted, per search, kept across runs
+SEEN_PATH = os.environ.get(
+    "FB_MARKETPLACE_SEEN",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "seen.db")
+)
+
+# A page where at least this share of listings is already known ends an incremental scrape
+KNOWN_PAGE_RATIO = 0.8
+
+# IDs not seen again for this long are dropped from the index
+SEEN_MAX_AGE = 90 * 24 * 60 * 60
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS seen ("
+    " scope TEXT NOT NULL,"
+    " listing_id TEXT NOT NULL,"
+    " seen_at REAL NOT NULL,"
+    " PRIMARY KEY (scope, listing_id)) WITHOUT ROWID",
+)
+
+
+class SeenIndex:
+    """
+    Persistent set of listing IDs seen per scope (query + location).
+
+    Backed by a WITHOUT ROWID SQLite table keyed on (scope, listing_id), so
+    the IDs are stored once, sorted, inside the primary key B-tree and a page
+    of IDs is checked with one indexed lookup. Like SharedCache it is safe
+    across processes and swallows every error: a broken index just means
+    every listing looks new.
+    """
+
+    def __init__(self, path=SEEN_PATH, max_age=SEEN_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self._local = threading.local()
+
+    def _connect(self):
+        return thread_connection(self._local, self.path, SCHEMA)
+
+    def unseen(self, scope, listing_ids):
+        """Return the subset of listing_ids not yet recorded for scope."""
+        listing_ids = set(listing_ids)
+        if not listing_ids:
+            return set()
+
+        try:
+            placeholders = ",".join("?" * len(listing_ids))
+            rows = self._connect().execute(
+                f"SELECT listing_id FROM seen WHERE scope = ? AND listing_id IN ({placeholders})",
+                (scope, *listing_ids)
+            ).fetchall()
+        except sqlite3.Error:
+            return listing_ids
+
+        return listing_ids - {row[0] for row in rows}
+
+    def add(self, scope, listing_ids):
+        """Record listing_ids as seen for scope, refreshing their timestamp."""
+        now = time.time()
+        try:
+            self._connect().executemany(
+                "INSERT OR REPLACE INTO seen (scope, listing_id, seen_at) VALUES (?, ?, ?)",
+                [(scope, listing_id, now) for listing_id in listing_ids]
+            )
+        except sqlite3.Error:
+            pass
+
+    def prune(self):
+        """Forget IDs that have not shown up for max_age seconds."""
+        try:
+            self._connect().execute("DELETE FROM seen WHERE seen_at < ?", (time.time() - self.max_age,))
+        except sqlite3.Error:
+            pass
+
+
+def mostly_known(page_ids, unseen_ids, ratio=KNOWN_PAGE_RATIO):
+    """True if at least ratio of a page's listings were already seen."""
+    if not page_ids:
+        return False
+    return (len(page_ids) - len(unseen_ids)) / len(page_ids) >= ratio
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from cache import thread_connection
+
+# Database of every listing scraped on this machine
+DB_PATH = os.environ.get(
+    "FB_MARKETPLACE_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "listings.db")
+)
+
+# Most rows a single query_listings call returns
+MAX_QUERY_LIMIT = 1000
+
+# Columns query_listings can sort by
+ORDER_COLUMNS = ("last_seen", "first_seen", "price_amount")
+
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS listings ("
+    " id TEXT PRIMARY KEY,"
+    " query TEXT,"
+    " title TEXT,"
+    " category_id TEXT,"
+    " city TEXT,"
+    " city_local TEXT,"
+    " price_amount REAL,"
+    " price_text TEXT,"
+    " is_sold INTEGER,"
+    " is_pending INTEGER,"
+    " data TEXT,"
+    " details TEXT,"
+    " first_seen REAL NOT NULL,"
+    " last_seen REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS listings_category_id ON listings (category_id)",
+    "CREATE INDEX IF NOT EXISTS listings_city ON listings (city COLLATE NOCASE)",
+    "CREATE INDEX IF NOT EXISTS listings_city_local ON listings (city_local COLLATE NOCASE)",
+    "CREATE INDEX IF NOT EXISTS listings_price_amount ON listings (price_amount)",
+    "CREATE INDEX IF NOT EXISTS listings_first_seen ON listings (first_seen)",
+    "CREATE INDEX IF NOT EXISTS listings_last_seen ON listings (last_seen)",
+)
+
+# Search results fill data, PDP results fill details; the indexed columns keep
+# whichever non-null value arrived last, and first_seen never changes
+UPSERT = (
+    "INSERT INTO listings (id, query, title, category_id, city, city_local, price_amount, price_text,"
+    " is_sold, is_pending, {column}, first_seen, last_seen)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    " ON CONFLICT (id) DO UPDATE SET"
+    " query = COALESCE(listings.query, excluded.query),"
+    " title = COALESCE(excluded.title, listings.title),"
+    " category_id = COALESCE(excluded.category_id, listings.category_id),"
+    " city = COALESCE(excluded.city, listings.city),"
+    " city_local = COALESCE(excluded.city_local, listings.city_local),"
+    " price_amount = COALESCE(excluded.price_amount, listings.price_amount),"
+    " price_text = COALESCE(excluded.price_text, listings.price_text),"
+    " is_sold = COALESCE(excluded.is_sold, listings.is_sold),"
+    " is_pending = COALESCE(excluded.is_pending, listings.is_pending),"
+    " {column} = excluded.{column},"
+    " last_seen = excluded.last_seen"
+)
+
+
+def _price(listing):
+    """(amount, display text) of a listing's price, either may be None."""
+    listing_price = listing.get("listing_price") or {}
+    try:
+        amount = float(listing_price.get("amount"))
+    except (TypeError, ValueError):
+        amount = None
+    return amount, listing_price.get("formatted_amount")
+
+
+def _city(listing):
+    """
+    (English name, local name) of a listing's city, either may be None.
+    reverse_geocode.city is in the seller's language (e.g. রাজশাহী), while
+    city_page.display_name starts with the English name (Rajshahi).
+    """
+    location = listing.get("location") or {}
+    reverse_geocode = location.get("reverse_geocode") or location.get("reverse_geocode_detailed") or {}
+    local = reverse_geocode.get("city") or (listing.get("location_text") or {}).get("text")
+    # display_name may carry the region too, e.g. "Dhaka, Bangladesh"
+    display_name = (reverse_geocode.get("city_page") or {}).get("display_name") or ""
+    english = display_name.split(",")[0].strip()
+    return english or local, local
+
+
+def _flag(value):
+    return None if value is None else int(bool(value))
+
+
+class ListingStore:
+    """
+    SQLite database of scraped listings, one row per listing ID.
+
+    Listings from extract_marketplace_listings and
+    extract_listing_from_pdp_response are upserted in batches, one
+    transaction per batch, with the fields people filter on (category, city,
+    price, first/last seen) copied into indexed columns. query_listings
+    answers questions like "under 500 in Rajshahi" without re-reading any
+    output file.
+    """
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        return thread_connection(self._local, self.path, SCHEMA, row_factory=sqlite3.Row)
+
+    def upsert_many(self, listings, query=None, source="search"):
+        """
+        Insert or update listings in one transaction. source is "search" for
+        extract_marketplace_listings output or "pdp" for PDP details.
+        Returns the number of rows written.
+        """
+        now = time.time()
+        column = "details" if source == "pdp" else "data"
+        rows = []
+        for listing in listings:
+            if not listing.get("id"):
+                continue
+            amount, price_text = _price(listing)
+            city, city_local = _city(listing)
+            rows.append((
+                str(listing["id"]),
+                query,
+                listing.get("marketplace_listing_title"),
+                listing.get("marketplace_listing_category_id"),
+                city,
+                city_local,
+                amount,
+                price_text,
+                _flag(listing.get("is_sold")),
+                _flag(listing.get("is_pending")),
+                json.dumps(listing, ensure_ascii=False),
+                now,
+                now,
+            ))
+        if not rows:
+            return 0
+
+        try:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(UPSERT.format(column=column), rows)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            print(f"Warning: could not store {len(rows)} listings: {e}")
+            return 0
+        return len(rows)
+
+    def query_listings(self, city=None, category_id=None, min_price=None, max_price=None, query=None,
+                       seen_since=None, include_sold=True, order_by="last_seen", limit=100, offset=0):
+        """
+        Return stored listings matching every given filter, newest first (or
+        cheapest first for order_by="price_amount"). city matches the English
+        or the local city name case-insensitively, seen_since is a unix
+        timestamp on last_seen. Each result
+        is the stored search listing with its PDP details under "details".
+        """
+        if order_by not in ORDER_COLUMNS:
+            raise ValueError(f"order_by must be one of {ORDER_COLUMNS}, got {order_by!r}")
+
+        where, params = [], []
+        if city:
+            where.append("(city = ? COLLATE NOCASE OR city_local = ? COLLATE NOCASE)")
+            params += [city, city]
+        if category_id:
+            where.append("category_id = ?")
+            params.append(category_id)
+        if min_price is not None:
+            where.append("price_amount >= ?")
+            params.append(min_price)
+        if max_price is not None:
+            where.append("price_amount <= ?")
+            params.append(max_price)
+        if query:
+            where.append("query = ?")
+            params.append(query)
+        if seen_since is not None:
+            where.append("last_seen >= ?")
+            params.append(seen_since)
+        if not include_sold:
+            where.append("COALESCE(is_sold, 0) = 0")
+
+        sql = "SELECT * FROM listings"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {order_by} {'ASC' if order_by == 'price_amount' else 'DESC'} LIMIT ? OFFSET ?"
+        params += [max(0, min(limit, MAX_QUERY_LIMIT)), max(0, offset)]
+
+        try:
+            rows = self._connect().execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            print(f"Warning: listing query failed: {e}")
+            return []
+        return [self._row_to_listing(row) for row in rows]
+
+    def get(self, listing_id):
+        """The stored listing with this ID, or None."""
+        try:
+            row = self._connect().execute("SELECT * FROM listings WHERE id = ?", (str(listing_id),)).fetchone()
+        except sqlite3.Error:
+            return None
+        return self._row_to_listing(row) if row else None
+
+    @staticmethod
+    def _row_to_listing(row):
+        listing = json.loads(row["data"]) if row["data"] else {"id": row["id"]}
+        listing["details"] = json.loads(row["details"]) if row["details"] else None
+        listing["query"] = row["query"]
+        listing["first_seen"] = row["first_seen"]
+        listing["last_seen"] = row["last_seen"]
+        return listing
@@ -0,0 +1,141 @@
+import math
+import asyncio
+from search import iter_search_pages
+
+# Kilometres per degree of latitude (and of longitude at the equator)
+KM_PER_DEGREE = 111.32
+
+# Pages are fetched for at most this many tiles at once
+TILE_CONCURRENCY = 8
+
+# A tile that returns this many listings and still has more is split into four
+TILE_CAP = 480
+
+# ...unless fewer than this share of them were new, i.e. the tile mostly repeats its neighbours
+SPLIT_MIN_NEW_RATIO = 0.1
+
+# Tiles are never split below this radius (km)
+MIN_TILE_RADIUS_KM = 5
+
+# How many times the search area is split before the first request (1 = 4 tiles, 2 = 16)
+INITIAL_SPLITS = 1
+
+
+def split_tile(tile):
+    """
+    Split a (lat, lon, radius_km) circle into four circles covering it: one per
+    quadrant of its bounding square, each centred on its quadrant with the
+    radius of the quadrant's circumscribed circle.
+    """
+    lat, lon, radius = tile
+    offset_km = radius / 2
+    dlat = offset_km / KM_PER_DEGREE
+    dlon = offset_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    child_radius = math.ceil(radius / math.sqrt(2))
+    return [
+        (round(lat + sign_lat * dlat, 6), round(lon + sign_lon * dlon, 6), child_radius)
+        for sign_lat in (1, -1)
+        for sign_lon in (1, -1)
+    ]
+
+
+def initial_tiles(browse_params, splits=INITIAL_SPLITS):
+    """The tiles a search over browse_params starts with."""
+    tiles = [(
+        float(browse_params["filter_location_latitude"]),
+        float(browse_params["filter_location_longitude"]),
+        int(browse_params.get("filter_radius_km") or 500),
+    )]
+    for _ in range(splits):
+        if tiles[0][2] / math.sqrt(2) < MIN_TILE_RADIUS_KM:
+            break
+        tiles = [child for tile in tiles for child in split_tile(tile)]
+    return tiles
+
+
+def tile_browse_params(browse_params, tile):
+    lat, lon, radius = tile
+    return {
+        **browse_params,
+        "filter_location_latitude": lat,
+        "filter_location_longitude": lon,
+        "filter_radius_km": radius,
+    }
+
+
+async def iter_tiled_pages(client, query, browse_params, doc_id, page_content, page_headers, graphql_headers,
+                           max_items=None, tile_cap=TILE_CAP, concurrency=TILE_CONCURRENCY, splits=INITIAL_SPLITS,
+                           page_url=None):
+    """
+    Partitioned version of search.iter_search_pages for one large search.
+
+    The browse_params circle is split into lat/lon/radius tiles that are
+    paginated concurrently (at most concurrency at a time), and their pages
+    are merged with listing-ID dedup, so a query over a wide radius is no
+    longer bound to one sequential cursor chain. A tile that fills tile_cap
+    and still has more pages is split into four smaller tiles, down to
+    MIN_TILE_RADIUS_KM, unless most of its listings were already found by
+    overlapping tiles. Yields pages of listings not yielded before.
+    """
+    seen_ids = set()  # shared by every tile, so each queued page only holds new listings
+    # Unbounded so the end-of-search marker can always be queued; tile caps bound its size
+    pages = asyncio.Queue()
+    slots = asyncio.Semaphore(concurrency)
+    tasks = set()
+
+    def spawn(tile):
+        task = asyncio.create_task(search_tile(tile))
+        tasks.add(task)
+        task.add_done_callback(tile_done)
+
+    def tile_done(task):
+        tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"❌ Error in tile search: {task.exception()}")
+        if not tasks:
+            pages.put_nowait(None)
+
+    async def search_tile(tile):
+        state = {}
+        received = new = 0
+        async with slots:
+            async for page_listings in iter_search_pages(client, query, tile_browse_params(browse_params, tile), doc_id,
+                                                         page_content, page_headers, graphql_headers, tile_cap,
+                                                         state=state, page_url=page_url):
+                received += len(page_listings)
+                new_listings = []
+                for listing in page_listings:
+                    if listing.get("id") not in seen_ids:
+                        seen_ids.add(listing.get("id"))
+                        new_listings.append(listing)
+                new += len(new_listings)
+                if new_listings:
+                    pages.put_nowait(new_listings)
+
+        # Split tiles that are too dense to page through within their cap; children
+        # are spawned before this task finishes, so the queue is never closed early
+        dense = received >= tile_cap and not state.get("done")
+        if dense and new >= received * SPLIT_MIN_NEW_RATIO and tile[2] / math.sqrt(2) >= MIN_TILE_RADIUS_KM:
+            print(f"Tile {tile} hit {tile_cap} listings, splitting")
+            for child in split_tile(tile):
+                spawn(child)
+
+    for tile in initial_tiles(browse_params, splits):
+        spawn(tile)
+
+    total = 0
+    try:
+        while max_items is None or total < max_items:
+            new_listings = await pages.get()
+            if new_listings is None:
+                return
+
+            if max_items is not None:
+                new_listings = new_listings[:max_items - total]
+            if new_listings:
+                total += len(new_listings)
+                yield new_listings
+    finally:
+        for task in list(tasks):
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)